@@ -1,15 +1,17 @@
 from typing import Tuple, Iterable, Set, List, Callable
 import ipaddress
-import contextlib
+import re
 from tqdm import tqdm
 from datetime import datetime as dt
 import time
-from collections import defaultdict
 import os
+import io
+import shutil
 import numpy as np
+import pandas as pd
 # import validators
-import joblib
-from joblib import Parallel, delayed
+from joblib.externals.loky import get_reusable_executor
+import concurrent.futures
 from os import path
 import itertools
 
@@ -17,10 +19,6 @@ ASN = int
 ASpath = List[ASN]
 ASlink = Tuple[ASN, ASN]
 
-as_rel_dict = None
-as_rank_dict = None
-as_country_codes_dict = None
-
 
 def get_AS_links(aspaths: Iterable[ASpath]) -> Set[ASlink]:
     return set(
@@ -52,44 +50,56 @@ def clean_ASpath(aspath: ASpath) -> ASpath:
     return return_path
 
 
-@contextlib.contextmanager
-def tqdm_joblib(tqdm_object):
-    """Context manager to patch joblib to report into tqdm progress bar given as argument"""
-
-    # credits:
-    # https://stackoverflow.com/questions/24983493/tracking-progress-of-joblib-parallel-execution
-    class TqdmBatchCompletionCallback(joblib.parallel.BatchCompletionCallBack):
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-
-        def __call__(self, *args, **kwargs):
-            tqdm_object.update(n=self.batch_size)
-            return super().__call__(*args, **kwargs)
-
-    old_batch_callback = joblib.parallel.BatchCompletionCallBack
-    joblib.parallel.BatchCompletionCallBack = TqdmBatchCompletionCallback
-    try:
-        yield tqdm_object
-    finally:
-        joblib.parallel.BatchCompletionCallBack = old_batch_callback
-        tqdm_object.close()
-
-
 def paral(function: Callable,
           iters: List[Iterable],
           num_cores=-1,
-          progress_bar=True):
+          progress_bar=True,
+          costs: List[float] = None,
+          memory: List[float] = None,
+          memory_budget: float = None):
     """ compute function parallel with arguments in iters.
-    function(iters[0][0],iters[0][1],...)"""
-
-    with tqdm_joblib(
-            tqdm(desc=function.__name__,
-                 unit="jobs",
-                 dynamic_ncols=True,
-                 total=len(iters[0]),
-                 disable=not progress_bar), ) as progress_bar:
-        return Parallel(n_jobs=num_cores, batch_size=1)(delayed(function)(*its)
-                                                        for its in zip(*iters))
+    function(iters[0][0],iters[0][1],...)
+
+    Jobs run on a worker pool that is reused by later calls. With costs
+    (e.g. input file sizes) the most expensive jobs start first. memory holds
+    the estimated peak RSS of each job in bytes, jobs only start while the
+    estimates of the running jobs fit into memory_budget (a job larger than
+    the budget runs alone). Results are returned in input order. """
+    jobs = list(zip(*iters))
+    if num_cores < 0:
+        num_cores = os.cpu_count() + 1 + num_cores
+    if memory is None:
+        memory = [0] * len(jobs)
+    order = list(range(len(jobs)))
+    if costs is not None or memory_budget is not None:
+        order.sort(key=lambda job: -(costs if costs is not None else memory)[
+            job])
+    executor = get_reusable_executor(max_workers=num_cores, timeout=None)
+
+    results = [None] * len(jobs)
+    running = dict()
+    used_memory = 0
+    with tqdm(desc=function.__name__,
+              unit="jobs",
+              dynamic_ncols=True,
+              total=len(jobs),
+              disable=not progress_bar) as progress:
+        while order or running:
+            # admit jobs largest first while they fit into the budget
+            while order and len(running) < num_cores and (
+                    memory_budget is None or not running
+                    or used_memory + memory[order[0]] <= memory_budget):
+                job = order.pop(0)
+                running[executor.submit(function, *jobs[job])] = job
+                used_memory += memory[job]
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                used_memory -= memory[job]
+                results[job] = future.result()
+                progress.update()
+    return results
 
 
 def link_on_path(link: ASlink, path: ASpath) -> bool:
@@ -112,6 +122,95 @@ def link_on_path(link: ASlink, path: ASpath) -> bool:
         return False
 
 
+class ASPaths:
+    """ a batch of AS paths in compressed sparse row form: the ASNs of all
+    paths in one uint32 array (asns) and the start of each path in it
+    (offsets, one more than paths). AS sets ({a,b}) are stored as ASN 0,
+    links to them are ignored. """
+
+    def __init__(self, asns: np.ndarray, offsets: np.ndarray):
+        self.asns = asns
+        self.offsets = offsets
+        self._link_index = None
+
+    @classmethod
+    def from_strings(cls, paths: Iterable[str]) -> "ASPaths":
+        """ builds the batch from space-separated paths, e.g. the path
+        column of a dump; empty values (withdrawals) are empty paths """
+        paths = pd.Series(paths, dtype=object).fillna("").astype(str)
+        lengths = np.array([len(path.split()) for path in paths],
+                           dtype=np.int64)
+        text = " ".join(paths)
+        if "{" in text:
+            text = re.sub(r"\{[^}]*\}", "0", text)
+        asns = np.fromstring(text, dtype=np.uint32, sep=" ")
+        if len(asns) != lengths.sum():
+            raise ValueError("paths contain tokens that are not ASNs")
+        return cls(asns, np.concatenate([[0], np.cumsum(lengths)]))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.asns[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def path_ids(self) -> np.ndarray:
+        """ index of the path of each ASN in asns """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def clean(self) -> "ASPaths":
+        """ removes ASs if the previous AS is identical (clean_ASpath) """
+        keep = np.ones(len(self.asns), dtype=bool)
+        keep[1:] = self.asns[1:] != self.asns[:-1]
+        # the first AS of a path is always kept
+        keep[self.offsets[:-1][self.lengths > 0]] = True
+        kept = np.concatenate([[0], np.cumsum(keep)])
+        return ASPaths(self.asns[keep], kept[self.offsets])
+
+    def links(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ links (n x 2 ASNs) of all paths and the path of each link, like
+        get_AS_links_single per path """
+        path_ids = self.path_ids
+        valid = ((path_ids[1:] == path_ids[:-1]) & (self.asns[1:] != 0) &
+                 (self.asns[:-1] != 0))
+        links = np.stack([self.asns[:-1][valid], self.asns[1:][valid]],
+                         axis=1)
+        return links, path_ids[1:][valid]
+
+    def unique_links(self) -> np.ndarray:
+        """ distinct links of all paths, like get_AS_links """
+        return np.unique(self.links()[0], axis=0)
+
+    def paths_with_link(self, link: ASlink) -> np.ndarray:
+        """ indices of the paths that contain link, from an inverted index
+        of all links that is built on the first query """
+        if self._link_index is None:
+            links, path_ids = self.links()
+            keys = pack_links(links)
+            order = np.lexsort((path_ids, keys))
+            keys, path_ids = keys[order], path_ids[order]
+            # each path once per link
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = (keys[1:] != keys[:-1]) | (path_ids[1:] !=
+                                                   path_ids[:-1])
+            self._link_index = (keys[first], path_ids[first])
+        keys, path_ids = self._link_index
+        key = pack_links([link])[0]
+        return path_ids[np.searchsorted(keys, key, side="left"):np.
+                        searchsorted(keys, key, side="right")]
+
+    def contain_link(self, link: ASlink) -> np.ndarray:
+        """ whether each path contains link, like link_on_path """
+        contained = np.zeros(len(self), dtype=bool)
+        contained[self.paths_with_link(link)] = True
+        return contained
+
+
 # def check_IPv4_syntax(ip: str) -> bool:
 #     return validators.ip_address.ipv4(ip)
 
@@ -119,65 +218,169 @@ def link_on_path(link: ASlink, path: ASpath) -> bool:
 #     return validators.ip_address.ipv6(ip)
 
 
-def init_as_rel(as_rel: str):
-    if not os.path.exists(as_rel):
-        raise FileNotFoundError(
-            "Could not find file.. Remember to use absolute paths")
+def _load_compiled(sources: List[str], cache: str, names: List[str],
+                   compile_: Callable) -> List[np.ndarray]:
+    """ memory-maps the arrays <cache>.<name>.npy compiled from the source
+    files, compiles them first if they are missing or older than a source.
+    The arrays are shared through the page cache by all processes. """
+    filenames = [f"{cache}.{name}.npy" for name in names]
+    for source in sources:
+        if not os.path.exists(source):
+            raise FileNotFoundError(
+                "Could not find file.. Remember to use absolute paths")
+    source_mtime = max(os.path.getmtime(source) for source in sources)
+    if any(not os.path.exists(filename)
+           or os.path.getmtime(filename) < source_mtime
+           for filename in filenames):
+        for filename, array in zip(filenames, compile_()):
+            # workers may compile concurrently, replace atomically
+            np.save(f"{filename}.{os.getpid()}.npy", array)
+            os.replace(f"{filename}.{os.getpid()}.npy", filename)
+    return [np.load(filename, mmap_mode="r") for filename in filenames]
+
+
+def _last_per_key(keys: np.ndarray, values: np.ndarray):
+    """ sorted unique keys and the last value given for each key """
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    last = np.append(keys[1:] != keys[:-1], True)
+    return keys[last], values[order][last]
+
+
+def _lookup(keys: np.ndarray, sorted_keys: np.ndarray, values: np.ndarray,
+            default) -> np.ndarray:
+    """ values of keys in sorted_keys, default for keys that are missing """
+    if len(sorted_keys) == 0:
+        return np.full(len(keys), default, dtype=values.dtype)
+    positions = np.searchsorted(sorted_keys, keys).clip(max=len(sorted_keys) -
+                                                        1)
+    return np.where(sorted_keys[positions] == keys, values[positions],
+                    default)
+
+
+# relationship of link (a, b) by code in as_rel_types
+relationship_names = np.array(["c2p", "p2p", "p2c", "None"])
+as_rel_links = None
+as_rel_types = None
+
+
+def pack_links(links: np.ndarray) -> np.ndarray:
+    """ packs links (n x 2 ASNs) into uint64 (a << 32 | b) """
+    links = np.asarray(links, dtype=np.uint64).reshape(-1, 2)
+    return links[:, 0] << np.uint64(32) | links[:, 1]
+
 
-    global as_rel_dict
-    lines = open(as_rel).read().splitlines()
-    lines = [line.split('|') for line in lines if '#' not in line]
-    keys = [tuple(line[:2]) for line in lines]
-    keys += list(map(lambda x: x[::-1], keys))
-    v_map = {-1: 'p2c', 0: 'p2p'}
-    values = [v_map[int(line[2])] for line in lines]
-    values += list(map(lambda x: x[::-1], values))
-    as_rel_dict = dict(zip(keys, values))
+def init_as_rel(as_rel: str):
+    """ loads the CAIDA as-rel file, compiled to <as_rel>.links.npy and
+    <as_rel>.types.npy on first use """
+
+    def compile_as_rel():
+        df = pd.read_csv(as_rel,
+                         sep='|',
+                         comment='#',
+                         header=None,
+                         usecols=[0, 1, 2],
+                         dtype=np.int64)
+        links = df[[0, 1]].to_numpy()
+        # -1: p2c, 0: p2p; the reversed link has the reversed relationship
+        types = np.where(df[2].to_numpy() == -1, 2, 1).astype(np.int8)
+        return _last_per_key(
+            np.concatenate([pack_links(links),
+                            pack_links(links[:, ::-1])]),
+            np.concatenate([types, 2 - types]))
+
+    global as_rel_links, as_rel_types
+    as_rel_links, as_rel_types = _load_compiled([as_rel], as_rel,
+                                                ["links", "types"],
+                                                compile_as_rel)
+
+
+def get_relationships(links: np.ndarray) -> np.ndarray:
+    """ relationships (p2c, c2p, p2p or None) of the links (n x 2 ASNs) """
+    assert as_rel_links is not None, "init_as_rel first"
+    return relationship_names[_lookup(pack_links(links), as_rel_links,
+                                      as_rel_types, 3)]
 
 
 def get_relationship(link: ASlink):
-    assert as_rel_dict is not None, "init_as_rel first"
-    try:
-        return as_rel_dict[link]
-    except KeyError:
-        return "None"
+    return str(get_relationships([link])[0])
+
+
+as_rank_asns = None
+as_rank_ranks = None
 
 
 def init_as_rank(as_rank_file: str):
-    if not os.path.exists(as_rank_file):
-        raise FileNotFoundError(
-            "Could not find file.. Remember to use absolute paths")
-    global as_rank_dict
-    as_rank_dict = defaultdict(
-        lambda: None,
-        dict(map(lambda x: (int(x[0]), int(x[1])), rsp(as_rank_file,
-                                                       sep=':'))))
+    """ loads the asn:rank file, compiled to <as_rank_file>.asns.npy and
+    <as_rank_file>.ranks.npy on first use """
+
+    def compile_as_rank():
+        df = pd.read_csv(as_rank_file, sep=':', header=None, dtype=np.int64)
+        return _last_per_key(df[0].to_numpy(np.uint64), df[1].to_numpy())
+
+    global as_rank_asns, as_rank_ranks
+    as_rank_asns, as_rank_ranks = _load_compiled([as_rank_file],
+                                                 as_rank_file,
+                                                 ["asns", "ranks"],
+                                                 compile_as_rank)
+
+
+def get_as_ranks(asns: np.ndarray) -> np.ndarray:
+    """ ranks of the ASNs, -1 for ASNs without rank """
+    assert as_rank_asns is not None, "init_as_rank first"
+    return _lookup(np.asarray(asns, dtype=np.uint64), as_rank_asns,
+                   as_rank_ranks, -1)
 
 
 def get_as_rank(asn: ASN) -> int:
-    return as_rank_dict[int(asn)]
+    rank = int(get_as_ranks([asn])[0])
+    return None if rank == -1 else rank
+
+
+as_country_asns = None
+as_country_codes = None
 
 
 def init_country_codes(resource_dir: str):
+    """ loads the ASN country codes of the RIR delegation files, compiled
+    to <resource_dir>as_country_codes.asns.npy and .codes.npy on first use """
     files = [
         "delegated-afrinic-extended-latest", "delegated-arin-extended-latest",
         "delegated-ripencc-extended-latest", "delegated-apnic-extended-latest",
         "delegated-lacnic-extended-latest"
     ]
     rirs = ["afrinic", "arin", "ripencc", "apnic", "lacnic"]
-    global as_country_codes_dict
-    as_country_codes_dict = defaultdict(lambda: None)
-    for filename, rir in zip(files, rirs):
-        lines = open(resource_dir + filename).read().splitlines()
-        lines = [line.split('|') for line in lines if '#' not in line]
-        for line in lines:
-            if line[0] == rir and line[1] != '*' and line[3] != '*' and line[
-                    2] == 'asn':
-                as_country_codes_dict[int(line[3])] = line[1]
+
+    def compile_country_codes():
+        asns = []
+        codes = []
+        for filename, rir in zip(files, rirs):
+            lines = open(resource_dir + filename).read().splitlines()
+            lines = [line.split('|') for line in lines if '#' not in line]
+            for line in lines:
+                if line[0] == rir and line[1] != '*' and line[
+                        3] != '*' and line[2] == 'asn':
+                    asns.append(int(line[3]))
+                    codes.append(line[1])
+        return _last_per_key(np.array(asns, dtype=np.uint64),
+                             np.array(codes, dtype="U2"))
+
+    global as_country_asns, as_country_codes
+    as_country_asns, as_country_codes = _load_compiled(
+        [resource_dir + filename for filename in files],
+        resource_dir + "as_country_codes", ["asns", "codes"],
+        compile_country_codes)
+
+
+def get_country_codes(asns: np.ndarray) -> np.ndarray:
+    """ country codes of the ASNs, "" for ASNs without country code """
+    assert as_country_asns is not None, "init_country_codes first"
+    return _lookup(np.asarray(asns, dtype=np.uint64), as_country_asns,
+                   as_country_codes, "")
 
 
 def get_country_code(asn: ASN) -> str:
-    return as_country_codes_dict[int(asn)]
+    return str(get_country_codes([asn])[0]) or None
 
 
 def get_cdf_space(data):
@@ -193,6 +396,593 @@ def log(message: str):
     print(str(dt.now()) + "\t| " + message)
 
 
+def read_penalty_events(filename: str) -> pd.DataFrame:
+    """ reads a *_penalty_events.gz file written by track_penalty """
+    return pd.read_csv(filename,
+                       sep='|',
+                       header=None,
+                       names=["ts", "ip", "prefix", "penalty"],
+                       dtype={
+                           "ts": np.int64,
+                           "ip": str,
+                           "prefix": str,
+                           "penalty": np.float64
+                       },
+                       float_precision="round_trip")
+
+
+def penalty_at(events: pd.DataFrame,
+               ts: int,
+               prefixes: Iterable[str] = None,
+               half_life: int = 15 * 60,
+               reuse_threshold: int = 750,
+               include_ts: bool = True) -> pd.Series:
+    """ computes the penalty of each prefix at time ts from penalty events.
+
+    Between two updates the penalty decays deterministically, so it is the
+    penalty of the last event before ts decayed by 0.5^(delta / half_life),
+    or 0 once it dropped below half the reuse threshold (Cisco reset).
+    Updates at ts itself are only considered if include_ts is set. Returns a
+    series prefix -> penalty for all prefixes (or the given prefixes) that
+    had an event before ts. """
+    if include_ts:
+        events = events[events["ts"] <= ts]
+    else:
+        events = events[events["ts"] < ts]
+    if prefixes is not None:
+        events = events[events["prefix"].isin(set(prefixes))]
+    last = events.drop_duplicates("prefix", keep="last")
+    penalties = last["penalty"].to_numpy() * (0.5**(
+        (ts - last["ts"].to_numpy()) / half_life))
+    penalties[penalties < reuse_threshold / 2] = 0
+    return pd.Series(penalties, index=last["prefix"].to_numpy(), name=ts)
+
+
+def penalty_snapshot(events: pd.DataFrame,
+                     save_time: int,
+                     half_life: int = 15 * 60,
+                     reuse_threshold: int = 750) -> pd.DataFrame:
+    """ computes the rows a *_saved_states.gz file contains for save_time,
+    i.e. all non-zero penalties based on the updates before save_time """
+    penalties = penalty_at(events,
+                           save_time,
+                           half_life=half_life,
+                           reuse_threshold=reuse_threshold,
+                           include_ts=False)
+    penalties = penalties[penalties != 0]
+    ips = events.drop_duplicates("prefix",
+                                 keep="last").set_index("prefix")["ip"]
+    return pd.DataFrame({
+        "ts": save_time,
+        "ip": ips.reindex(penalties.index).to_numpy(),
+        "prefix": penalties.index,
+        "penalty": penalties.to_numpy()
+    })
+
+
+def read_suppressions(filename: str,
+                      prefixes: Iterable[str] = None) -> pd.DataFrame:
+    """ reads a *_suppressions.txt table written by track_penalty.
+
+    If prefixes are given, only their rows are read by seeking to the
+    offsets listed in the accompanying *_suppressions_index.txt. """
+    names = ["start", "end", "ip", "prefix", "max_penalty"]
+    dtype = {
+        "start": np.int64,
+        "end": np.int64,
+        "ip": str,
+        "prefix": str,
+        "max_penalty": np.float64
+    }
+    if prefixes is None:
+        if os.path.getsize(filename) == 0:
+            return pd.DataFrame(columns=names)
+        return pd.read_csv(filename,
+                           sep='|',
+                           header=None,
+                           names=names,
+                           dtype=dtype,
+                           float_precision="round_trip")
+
+    prefixes = set(prefixes)
+    offsets = []
+    for line in open(filename.replace(".txt", "_index.txt")):
+        prefix, prefix_offsets = line.rstrip('\n').split('|')
+        if prefix in prefixes:
+            offsets += map(int, prefix_offsets.split(','))
+
+    rows = []
+    with open(filename, "rb") as table:
+        for offset in sorted(offsets):
+            table.seek(offset)
+            rows.append(table.readline().decode().rstrip('\n').split('|'))
+    return pd.DataFrame(rows, columns=names).astype(dtype)
+
+
+class PrefixStateTable:
+    """ RFD state of one simulation, stored in parallel typed arrays.
+
+    Prefixes are mapped to dense slots through their integer encoding
+    (enc_v4_prefix/enc_v6_prefix). A prefix whose penalty has decayed to
+    0 behaves exactly like a prefix that was never seen, unless its last
+    update was a withdrawal (readvertisement penalty), so decay() frees
+    such slots again. Memory is therefore bounded by the number of prefixes
+    that are currently flapping or withdrawn. """
+
+    def __init__(self, version, capacity=1024):
+        self.encode = enc_v6_prefix if version == "v6" else enc_v4_prefix
+        # last update types, index 0 is the initial empty type
+        self.update_types = ["", "A", "W"]
+        # encoded prefix -> slot
+        self.slots = dict()
+        # slot -> encoded prefix and prefix string, None for free slots
+        self.keys = [None] * capacity
+        self.prefixes = [None] * capacity
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.used = np.zeros(capacity, dtype=bool)
+        self.penalty = np.zeros(capacity, dtype=np.float64)
+        self.last_penalty_reduction = np.zeros(capacity, dtype=np.int64)
+        self.last_update_type = np.zeros(capacity, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _grow(self):
+        capacity = len(self.used)
+        self.keys += [None] * capacity
+        self.prefixes += [None] * capacity
+        self.free_slots += list(range(2 * capacity - 1, capacity - 1, -1))
+        for name in [
+                "used", "penalty", "last_penalty_reduction", "last_update_type"
+        ]:
+            array = getattr(self, name)
+            setattr(self, name,
+                    np.concatenate([array, np.zeros_like(array)]))
+
+    def slot(self, prefix, ts):
+        """ returns the slot of prefix, a fresh one (penalty 0, last update
+        type "", last penalty reduction ts) if the prefix is not present """
+        key = self.encode(prefix)
+        slot = self.slots.get(key)
+        if slot is None:
+            if not self.free_slots:
+                self._grow()
+            slot = self.free_slots.pop()
+            self.slots[key] = slot
+            self.keys[slot] = key
+            self.prefixes[slot] = prefix
+            self.used[slot] = True
+            self.penalty[slot] = 0
+            self.last_penalty_reduction[slot] = ts
+            self.last_update_type[slot] = 0
+        return slot
+
+    def get_last_update_type(self, slot):
+        return self.update_types[self.last_update_type[slot]]
+
+    def set_last_update_type(self, slot, upd_type):
+        if upd_type not in self.update_types:
+            self.update_types.append(upd_type)
+        self.last_update_type[slot] = self.update_types.index(upd_type)
+
+    def decay(self, ts, half_life, reuse_threshold):
+        """ decays the penalties of all prefixes to ts, resets them to 0 below
+        half the reuse threshold (Cisco) and evicts fully decayed prefixes.
+        Returns the slots with a non-zero penalty. """
+        slots = np.flatnonzero(self.used)
+        delta = ts - self.last_penalty_reduction[slots]
+        assert (delta >= 0).all(), "delta can't be less than 0"
+
+        # new penalty is N_0 * 0.5^(delta / half_life)
+        penalty = self.penalty[slots] * (0.5**(delta / (half_life)))
+        penalty[penalty < reuse_threshold / 2] = 0
+        self.penalty[slots] = penalty
+        self.last_penalty_reduction[slots] = ts
+
+        withdrawn = self.last_update_type[slots] == self.update_types.index(
+            'W')
+        for slot in slots[(penalty == 0) & ~withdrawn].tolist():
+            del self.slots[self.keys[slot]]
+            self.keys[slot] = None
+            self.prefixes[slot] = None
+            self.used[slot] = False
+            self.free_slots.append(slot)
+
+        return slots[penalty != 0]
+
+
+class StateStore:
+    """ partitioned store of penalty snapshots.
+
+    Rows are kept in one block per block_length seconds of save time. Each
+    block is a compressed .npz file of the columns save_time, prefix_id and
+    penalty, sorted by save time. index.csv lists the blocks with their save
+    time range and row count, prefixes.txt maps prefix ids (line numbers) to
+    prefixes. Both are only appended to while writing, so a block that is
+    rewritten (see truncate) is listed again and its last row counts.
+    write_arrays() takes snapshot columns, write() takes ts|ip|prefix|penalty
+    lines like the gzip handle of a states file. """
+
+    def __init__(self, path, append=False, block_length=60 * 60):
+        self.path = path
+        self.block_length = block_length
+        if not append and os.path.exists(path):
+            shutil.rmtree(path)
+        prep_dir(path)
+
+        self.prefix_ids = dict()
+        self.new_prefixes = []
+        self.blocks = pd.DataFrame(
+            columns=["block", "first_save_time", "last_save_time", "rows"])
+        self.pending = []
+        self.pending_block = None
+        if append and os.path.exists(f"{path}/index.csv"):
+            self.blocks = read_state_index(path)
+            prefixes = open(f"{path}/prefixes.txt").read().splitlines()
+            self.prefix_ids = dict(zip(prefixes, range(len(prefixes))))
+        else:
+            self.blocks.to_csv(f"{path}/index.csv", index=False)
+            open(f"{path}/prefixes.txt", "w").close()
+
+    @property
+    def rows(self):
+        # the pending block may still be listed with its previous rows
+        listed = self.blocks["block"] != self.pending_block
+        return int(self.blocks["rows"][listed].sum()) + sum(
+            len(block["save_time"]) for block in self.pending)
+
+    def _read_block(self, block):
+        with np.load(f"{self.path}/{block}.npz") as columns:
+            return {name: columns[name] for name in columns.files}
+
+    def _flush(self):
+        if self.pending_block is None:
+            return
+        columns = {
+            name: np.concatenate([block[name] for block in self.pending])
+            for name in ["save_time", "prefix_id", "penalty"]
+        }
+        order = np.argsort(columns["save_time"], kind="stable")
+        columns = {name: column[order] for name, column in columns.items()}
+
+        # prefixes first and the index row last, so that every listed block
+        # only refers to written prefixes
+        with open(f"{self.path}/prefixes.txt", "a") as prefixes:
+            prefixes.write("".join(prefix + "\n"
+                                   for prefix in self.new_prefixes))
+        self.new_prefixes = []
+        np.savez_compressed(f"{self.path}/{self.pending_block}.npz",
+                            **columns)
+        row = self._index_block(self.pending_block, columns)
+        pd.DataFrame([row]).to_csv(f"{self.path}/index.csv",
+                                   mode="a",
+                                   header=False,
+                                   index=False)
+        self.pending = []
+        self.pending_block = None
+
+    def _index_block(self, block, columns):
+        """ lists a written block in the index, replacing its previous row,
+        returns the row """
+        row = [
+            block, columns["save_time"].min(), columns["save_time"].max(),
+            len(columns["save_time"])
+        ]
+        listed = np.flatnonzero(self.blocks["block"] == block)
+        if len(listed):
+            self.blocks.loc[listed[0]] = row
+        else:
+            self.blocks.loc[len(self.blocks)] = row
+        return row
+
+    def write_arrays(self, save_times, prefixes, penalties):
+        """ appends rows given as arrays of save times, prefixes and
+        penalties """
+        if len(save_times) == 0:
+            return
+        codes, uniques = pd.factorize(np.asarray(prefixes, dtype=object))
+        unique_ids = np.empty(len(uniques), dtype=np.uint32)
+        for position, prefix in enumerate(uniques):
+            prefix_id = self.prefix_ids.get(prefix)
+            if prefix_id is None:
+                prefix_id = len(self.prefix_ids)
+                self.prefix_ids[prefix] = prefix_id
+                self.new_prefixes.append(prefix)
+            unique_ids[position] = prefix_id
+        prefix_ids = unique_ids[codes]
+        save_times = np.asarray(save_times, dtype=np.int64)
+        penalties = np.asarray(penalties, dtype=np.float64)
+
+        # rows arrive sorted by save time, so a block is complete once a row
+        # of a later block arrives
+        blocks = save_times // self.block_length * self.block_length
+        for block in np.unique(blocks):
+            if self.pending_block is not None and block != self.pending_block:
+                self._flush()
+            self.pending_block = int(block)
+            in_block = blocks == block
+            self.pending.append({
+                "save_time": save_times[in_block],
+                "prefix_id": prefix_ids[in_block],
+                "penalty": penalties[in_block]
+            })
+
+    def write(self, data):
+        """ appends ts|ip|prefix|penalty lines """
+        if not data:
+            return
+        rows = pd.read_csv(io.BytesIO(data),
+                           sep='|',
+                           header=None,
+                           names=["save_time", "ip", "prefix", "penalty"],
+                           dtype={
+                               "save_time": np.int64,
+                               "prefix": str
+                           },
+                           float_precision="round_trip")
+        self.write_arrays(rows["save_time"].to_numpy(),
+                          rows["prefix"].to_numpy(),
+                          rows["penalty"].to_numpy())
+
+    def truncate(self, rows):
+        """ drops all rows after the first rows rows and continues writing
+        into the last remaining block. Blocks stay listed in the index until
+        their replacement is written. """
+        self._flush()
+        kept = np.array(self.blocks["rows"].cumsum() <= rows)
+        cut = rows - int(self.blocks["rows"][kept].sum())
+        if cut > 0 and kept.all():
+            log(f"{self.path} holds only {self.rows} of {rows} rows, "
+                    "continuing after the last indexed row")
+        elif cut > 0:
+            position = int(np.flatnonzero(~kept)[0])
+            block = int(self.blocks["block"][position])
+            columns = {
+                name: column[:cut]
+                for name, column in self._read_block(block).items()
+            }
+            np.savez_compressed(f"{self.path}/{block}.npz", **columns)
+            self._index_block(block, columns)
+            kept[position] = True
+
+        # resuming is rare, so the index is rewritten without the dropped
+        # blocks and replaced rows here
+        removed = self.blocks["block"][~kept].tolist()
+        self.blocks = self.blocks[kept].reset_index(drop=True)
+        self.blocks.to_csv(f"{self.path}/index.csv", index=False)
+        for block in removed:
+            os.remove(f"{self.path}/{block}.npz")
+
+        if len(self.blocks):
+            self.pending_block = int(self.blocks["block"].iloc[-1])
+            self.pending = [self._read_block(self.pending_block)]
+
+    def close(self):
+        self._flush()
+
+
+def read_state_index(path: str) -> pd.DataFrame:
+    """ reads the block index of a state store, a block that was rewritten
+    is listed with its last row """
+    blocks = pd.read_csv(f"{path}/index.csv")
+    blocks = blocks.drop_duplicates("block", keep="last")
+    return blocks.sort_values("block").reset_index(drop=True)
+
+
+def read_state_store(path: str,
+                     start: int = None,
+                     end: int = None,
+                     prefixes: Iterable[str] = None,
+                     min_penalty: float = None) -> pd.DataFrame:
+    """ reads penalty snapshots from a store written by track_penalty with
+    snapshot_store enabled.
+
+    Only the blocks overlapping [start, end] are loaded. Rows are filtered
+    by save time, prefix and minimum penalty. """
+    blocks = read_state_index(path)
+    if start is not None:
+        blocks = blocks[blocks["last_save_time"] >= start]
+    if end is not None:
+        blocks = blocks[blocks["first_save_time"] <= end]
+    prefix_names = np.array(
+        open(f"{path}/prefixes.txt").read().splitlines(), dtype=object)
+    if prefixes is not None:
+        prefix_ids = np.flatnonzero(np.isin(prefix_names, list(prefixes)))
+
+    parts = []
+    for block in blocks["block"]:
+        with np.load(f"{path}/{block}.npz") as columns:
+            save_time = columns["save_time"]
+            prefix_id = columns["prefix_id"]
+            penalty = columns["penalty"]
+        # blocks are sorted by save time
+        first = 0 if start is None else np.searchsorted(save_time, start)
+        last = len(save_time) if end is None else np.searchsorted(
+            save_time, end, side="right")
+        keep = np.zeros(len(save_time), dtype=bool)
+        keep[first:last] = True
+        if prefixes is not None:
+            keep &= np.isin(prefix_id, prefix_ids)
+        if min_penalty is not None:
+            keep &= penalty >= min_penalty
+        parts.append(
+            pd.DataFrame({
+                "save_time": save_time[keep],
+                "prefix": prefix_names[prefix_id[keep]],
+                "penalty": penalty[keep]
+            }))
+
+    if not parts:
+        return pd.DataFrame({
+            "save_time": np.array([], dtype=np.int64),
+            "prefix": np.array([], dtype=object),
+            "penalty": np.array([], dtype=np.float64)
+        })
+    return pd.concat(parts, ignore_index=True)
+
+
+def write_block_index(filename: str, blocks: List[Tuple[int, int, str,
+                                                         str]]):
+    """ writes the block index of a compressed dump to filename.index.
+
+    A block is an independently decompressible gzip member of the dump,
+    given as (offset, length, rc-project, rc-name). """
+    with open(filename + ".index", "w") as index:
+        index.write("".join(f"{offset}|{length}|{rc_project}|{rc_name}\n"
+                            for offset, length, rc_project, rc_name in blocks))
+
+
+def read_block_index(filename: str) -> List[Tuple[int, int, str, str]]:
+    """ reads the block index written by write_block_index, None if the dump
+    has no index """
+    if not os.path.exists(filename + ".index"):
+        return None
+    blocks = []
+    for line in open(filename + ".index"):
+        offset, length, rc_project, rc_name = line.rstrip('\n').split('|')
+        blocks.append((int(offset), int(length), rc_project, rc_name))
+    return blocks
+
+
+def find_duplicates(keys: np.ndarray, updates: np.ndarray,
+                    last_update: dict) -> np.ndarray:
+    """ marks updates that equal the previous update with the same key.
+
+    keys and updates are uint64 hashes (e.g. of the prefix and of the
+    compared columns), last_update maps keys to the last update seen in
+    earlier calls and is updated. """
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    updates = updates[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    last = np.ones(len(keys), dtype=bool)
+    last[:-1] = first[1:]
+    previous = np.empty_like(updates)
+    previous[1:] = updates[:-1]
+    duplicate = previous == updates
+    duplicate[first] = [
+        last_update.get(key) == update
+        for key, update in zip(keys[first].tolist(), updates[first].tolist())
+    ]
+    last_update.update(zip(keys[last].tolist(), updates[last].tolist()))
+
+    duplicates = np.empty(len(keys), dtype=bool)
+    duplicates[order] = duplicate
+    return duplicates
+
+
+class DumpColumnsWriter:
+    """ writes a per-VP dump in columnar form, an alternative to the
+    pipe-separated *_dumps.gz files.
+
+    The dump is a directory with one compressed .npz file per written batch
+    (part-<n>.npz). ts is stored as float64, all other columns as uint32
+    codes into a per-column dictionary (<column>.dict, line number = code)
+    that is only ever appended to. schema.txt lists the columns in order.
+    Writing appends to an existing dump. """
+
+    def __init__(self, path):
+        self.path = path
+        prep_dir(path)
+        self.columns = None
+        self.dictionaries = dict()
+        if os.path.exists(f"{path}/schema.txt"):
+            self.columns = open(f"{path}/schema.txt").read().splitlines()
+            for column in self.columns:
+                if column != "ts":
+                    values = open(f"{path}/{column}.dict").read().split('\n')
+                    self.dictionaries[column] = dict(
+                        zip(values[:-1], range(len(values) - 1)))
+        self.parts = count_dump_parts(path)
+
+    def write(self, df: pd.DataFrame):
+        """ appends the rows of df, empty values are stored as "" """
+        if not df.columns.is_unique:
+            raise ValueError(
+                f"duplicate columns in {self.path}: {df.columns.tolist()}")
+        if self.columns is None:
+            self.columns = df.columns.tolist()
+            with open(f"{self.path}/schema.txt", "w") as schema:
+                schema.write("".join(column + "\n" for column in self.columns))
+            for column in self.columns:
+                if column != "ts":
+                    self.dictionaries[column] = dict()
+                    open(f"{self.path}/{column}.dict", "w").close()
+
+        arrays = {"ts": df["ts"].to_numpy(np.float64)}
+        for column in self.columns:
+            if column == "ts":
+                continue
+            values = df[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.cat.remove_unused_categories()
+            else:
+                values = values.astype("category")
+            dictionary = self.dictionaries[column]
+            new_values = []
+            codes = []
+            # the last code is for missing values (category code -1)
+            for value in values.cat.categories.tolist() + [""]:
+                value = str(value)
+                if value not in dictionary:
+                    dictionary[value] = len(dictionary)
+                    new_values.append(value)
+                codes.append(dictionary[value])
+            # the dictionary is written before any part that uses it
+            if new_values:
+                with open(f"{self.path}/{column}.dict",
+                          "a") as dictionary_file:
+                    dictionary_file.write("".join(value + "\n"
+                                                  for value in new_values))
+            arrays[column] = np.array(
+                codes, dtype=np.uint32)[values.cat.codes.to_numpy()]
+
+        np.savez_compressed(f"{self.path}/part-{self.parts:06d}.npz",
+                            **arrays)
+        self.parts += 1
+
+    def close(self):
+        pass
+
+
+def read_dump_columns(path: str,
+                      columns: Iterable[str] = None,
+                      parts: Iterable[int] = None) -> pd.DataFrame:
+    """ reads a dump written by DumpColumnsWriter. Only the given columns
+    (default: all) and parts (default: all) are loaded. Dictionary-encoded
+    columns are returned as categoricals. """
+    schema = open(f"{path}/schema.txt").read().splitlines() if os.path.exists(
+        f"{path}/schema.txt") else []
+    columns = schema if columns is None else list(columns)
+    if parts is None:
+        parts = range(count_dump_parts(path))
+
+    arrays = {column: [] for column in columns}
+    for part in parts:
+        with np.load(f"{path}/part-{part:06d}.npz") as part_arrays:
+            for column in columns:
+                arrays[column].append(part_arrays[column])
+
+    df = dict()
+    for column in columns:
+        if column == "ts":
+            df[column] = np.concatenate(arrays[column]) if arrays[
+                column] else np.array([], dtype=np.float64)
+            continue
+        codes = np.concatenate(arrays[column]) if arrays[column] else np.array(
+            [], dtype=np.uint32)
+        values = open(f"{path}/{column}.dict").read().split('\n')[:-1]
+        df[column] = pd.Categorical.from_codes(codes.astype(np.int64),
+                                               categories=values)
+    return pd.DataFrame(df, columns=columns)
+
+
+def count_dump_parts(path: str) -> int:
+    """ number of parts of a dump written by DumpColumnsWriter """
+    return len([name for name in os.listdir(path) if name.startswith("part-")])
+
+
 def enc_v4_prefix(prefix):
     """Encodes an IPv4 prefix (x.y.z.w/len) as a 33-bit integer."""
     # credit:
@@ -261,9 +1051,288 @@ def dec_v6_prefix(x):
     return "{}/{}".format(address_str, length)
 
 
+def _low_ones(bits: np.ndarray) -> np.ndarray:
+    """ uint64 with the rightmost bits (0 to 64) set """
+    ones = (np.uint64(1) << np.minimum(bits, 63).astype(
+        np.uint64)) - np.uint64(1)
+    return np.where(bits >= 64, ~np.uint64(0), ones)
+
+
+def _bit_position(x: np.ndarray) -> np.ndarray:
+    """ position of the rightmost 1-bit of uint64 values (0 for 0) """
+    first_bit_set = x & (~x + np.uint64(1))
+    return np.log2(np.maximum(first_bit_set, np.uint64(1)).astype(
+        np.float64)).astype(np.int64)
+
+
+def enc_v4_prefixes(prefixes: Iterable[str]) -> np.ndarray:
+    """ enc_v4_prefix for a batch of prefixes, as uint64 """
+    codes, uniques = pd.factorize(np.asarray(prefixes, dtype=object))
+    fields = np.fromstring(" ".join(uniques).replace('.', ' ').replace(
+        '/', ' '),
+                           dtype=np.int64,
+                           sep=" ")
+    if len(fields) != 5 * len(uniques):
+        raise ValueError("not an IPv4 prefix")
+    fields = fields.reshape(-1, 5)
+    if (fields[:, :4] > 255).any() or (fields[:, 4] > 32).any():
+        raise ValueError("not an IPv4 prefix")
+    address_int = (fields[:, 0] << 24 | fields[:, 1] << 16
+                   | fields[:, 2] << 8 | fields[:, 3]).astype(np.uint64)
+    inv_length = (32 - fields[:, 4]).astype(np.uint64)
+
+    # Encode.
+    notch = np.uint64(1) << inv_length
+    address_int &= ~(notch - np.uint64(1))
+    return ((address_int << np.uint64(1)) | notch)[codes]
+
+
+def dec_v4_prefixes(x: np.ndarray) -> np.ndarray:
+    """ dec_v4_prefix for a batch of encoded prefixes, as object array """
+    x, codes = np.unique(np.asarray(x, dtype=np.uint64), return_inverse=True)
+    lengths = 32 - _bit_position(x)
+    address_ints = (x & (x - np.uint64(1))) >> np.uint64(1)
+    octets = address_ints.astype(">u4").view(np.uint8).reshape(-1, 4)
+    prefixes = np.array([
+        f"{a}.{b}.{c}.{d}/{length}"
+        for (a, b, c, d), length in zip(octets.tolist(), lengths.tolist())
+    ],
+                        dtype=object)
+    return np.where(x == 0, None, prefixes)[codes.reshape(-1)]
+
+
+# a 129-bit encoded IPv6 prefix (see enc_v6_prefix), fields in the order of
+# significance so that sorting by them sorts by the encoded value
+v6_prefix_dtype = np.dtype([("top", np.uint8), ("high", np.uint64),
+                            ("low", np.uint64)])
+
+
+def enc_v6_prefixes(prefixes: Iterable[str]) -> np.ndarray:
+    """ enc_v6_prefix for a batch of prefixes, as v6_prefix_dtype """
+    codes, uniques = pd.factorize(np.asarray(prefixes, dtype=object))
+    addresses, lengths = zip(*(prefix.split('/')
+                               for prefix in uniques)) if len(uniques) else (
+                                   (), ())
+    address_ints = np.frombuffer(b"".join(
+        ipaddress.IPv6Address(address).packed for address in addresses),
+                                 dtype=">u8").reshape(-1, 2).astype(np.uint64)
+    inv_length = 128 - np.array(lengths, dtype=np.int64)
+    if ((inv_length < 0) | (inv_length > 128)).any():
+        raise ValueError("not an IPv6 prefix")
+
+    # clear the rightmost bits
+    high = address_ints[:, 0] & ~_low_ones(np.maximum(inv_length - 64, 0))
+    low = address_ints[:, 1] & ~_low_ones(inv_length)
+
+    # make room and place notch
+    encoded = np.zeros(len(uniques), dtype=v6_prefix_dtype)
+    encoded["top"] = high >> np.uint64(63)
+    encoded["high"] = (high << np.uint64(1)) | (low >> np.uint64(63))
+    encoded["low"] = low << np.uint64(1)
+    notch = np.uint64(1) << (inv_length % 64).astype(np.uint64)
+    encoded["low"] |= np.where(inv_length < 64, notch, np.uint64(0))
+    encoded["high"] |= np.where((inv_length >= 64) & (inv_length < 128),
+                                notch, np.uint64(0))
+    encoded["top"] |= inv_length == 128
+    return encoded[codes]
+
+
+def _split_v6_prefixes(x: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """ address (high and low 64 bits) and length of encoded IPv6 prefixes
+    (v6_prefix_dtype) """
+    top = x["top"].astype(np.uint64)
+    high = x["high"]
+    low = x["low"]
+    inv_length = np.where(
+        low != 0, _bit_position(low),
+        np.where(high != 0, 64 + _bit_position(high), 128))
+
+    # clear the notch and shift the address back
+    low = low & (low - np.uint64(1))
+    high = np.where(x["low"] == 0, high & (high - np.uint64(1)), high)
+    top = np.where((x["low"] == 0) & (x["high"] == 0), np.uint64(0), top)
+    return ((top << np.uint64(63)) | (high >> np.uint64(1)),
+            (high << np.uint64(63)) | (low >> np.uint64(1)), 128 - inv_length)
+
+
+def dec_v6_prefixes(x: np.ndarray) -> np.ndarray:
+    """ dec_v6_prefix for a batch of encoded prefixes (v6_prefix_dtype), as
+    object array """
+    # unique by bytes, much faster than comparing the fields
+    x, codes = np.unique(np.ascontiguousarray(x, dtype=v6_prefix_dtype).view(
+        np.dtype((np.void, v6_prefix_dtype.itemsize))),
+                         return_inverse=True)
+    x = x.view(v6_prefix_dtype)
+    high, low, lengths = _split_v6_prefixes(x)
+    address_ints = np.stack([high, low], axis=1).astype(">u8")
+    prefixes = np.array([
+        f"{ipaddress.IPv6Address(address.tobytes())}/{length}"
+        for address, length in zip(address_ints, lengths)
+    ],
+                        dtype=object)
+    empty = (x["top"] == 0) & (x["high"] == 0) & (x["low"] == 0)
+    return np.where(empty, None, prefixes)[codes.reshape(-1)]
+
+
+class PrefixIndex:
+    """ index of IPv4 and IPv6 prefixes for longest prefix match, covering
+    and more-specifics queries.
+
+    A prefix is the address interval [first, last]; two prefixes are either
+    nested or disjoint. The distinct prefixes are sorted by (version, first
+    address, length), so the more-specifics of a prefix directly follow it,
+    and each one knows its parent, the longest other indexed prefix that
+    covers it. Addresses are split into high and low 64 bits, IPv4
+    addresses are low. Query results are positions in prefixes, -1 if
+    there is none. """
+
+    def __init__(self, prefixes: Iterable[str]):
+        prefixes = pd.unique(np.asarray(prefixes, dtype=object))
+        keys = self._keys(prefixes)
+        order = np.lexsort(keys[::-1])
+        self.prefixes = prefixes[order]
+        self.version, self.high, self.low, self.length = [
+            key[order] for key in keys
+        ]
+        self.last_high, self.last_low = self._last(self.version, self.high,
+                                                   self.low, self.length)
+
+        # (version, first address, length) as byte strings, sorted
+        self.sort_keys = self._sort_keys(self.version, self.high, self.low,
+                                         self.length)
+
+        # the prefixes before a prefix either cover it or end before it, so
+        # its depth (number of covering prefixes) is its position minus the
+        # number of prefixes that end before it starts
+        n = len(self.prefixes)
+        position = np.arange(n)
+        ends = np.sort(
+            self._sort_keys(self.version, self.last_high, self.last_low))
+        depth = position - np.searchsorted(
+            ends, self._sort_keys(self.version, self.high, self.low), "left")
+        # the parent is the last earlier prefix one level up
+        by_depth = np.lexsort((position, depth))
+        parent = np.searchsorted(depth[by_depth] * (n + 1) + by_depth,
+                                 (depth - 1) * (n + 1) + position, "left") - 1
+        self.parent = np.where(depth > 0, by_depth[parent], -1)
+
+    @staticmethod
+    def _keys(prefixes: np.ndarray) -> List[np.ndarray]:
+        """ version (4 or 6), address (high, low) and length of prefixes
+        from their enc_v4_prefix/enc_v6_prefix encoding """
+        is_v6 = np.array([':' in prefix for prefix in prefixes], dtype=bool)
+        version = np.where(is_v6, 6, 4).astype(np.uint8)
+        high = np.zeros(len(prefixes), dtype=np.uint64)
+        low = np.zeros(len(prefixes), dtype=np.uint64)
+        length = np.zeros(len(prefixes), dtype=np.int64)
+
+        v4 = enc_v4_prefixes(prefixes[~is_v6])
+        low[~is_v6] = (v4 & (v4 - np.uint64(1))) >> np.uint64(1)
+        length[~is_v6] = 32 - _bit_position(v4)
+        high[is_v6], low[is_v6], length[is_v6] = _split_v6_prefixes(
+            enc_v6_prefixes(prefixes[is_v6]))
+        return [version, high, low, length]
+
+    @staticmethod
+    def _last(version, high, low, length) -> Tuple[np.ndarray, np.ndarray]:
+        """ last address (high, low) of prefixes """
+        inv_length = np.where(version == 6, 128, 32) - length
+        return (high | _low_ones(np.maximum(inv_length - 64, 0)),
+                low | _low_ones(inv_length))
+
+    @staticmethod
+    def _sort_keys(version, high, low, length=None) -> np.ndarray:
+        """ byte strings that sort like (version, high, low[, length]) """
+        fields = [("version", "u1"), ("high", ">u8"), ("low", ">u8")]
+        if length is not None:
+            fields.append(("length", "u1"))
+        keys = np.zeros(len(version), dtype=fields)
+        keys["version"] = version
+        keys["high"] = high
+        keys["low"] = low
+        if length is not None:
+            keys["length"] = length
+        return keys.view(np.dtype((np.void, keys.dtype.itemsize)))
+
+    def _searchsorted(self, keys: List[np.ndarray], side: str) -> np.ndarray:
+        """ np.searchsorted for (version, high, low, length) keys """
+        return np.searchsorted(self.sort_keys, self._sort_keys(*keys), side)
+
+    def longest_match(self, prefixes: Iterable[str]) -> np.ndarray:
+        """ longest indexed prefix that covers or equals each prefix """
+        return self._longest_match(
+            self._keys(np.asarray(prefixes, dtype=object)))
+
+    def _longest_match(self, keys: List[np.ndarray]) -> np.ndarray:
+        version, high, low, length = keys
+        # the last prefix starting at or before the query is the longest
+        # match or one of its more-specifics
+        match = self._searchsorted([version, high, low, length], "right") - 1
+        while True:
+            candidates = np.flatnonzero(match >= 0)
+            matched = match[candidates]
+            covers = ((self.version[matched] == version[candidates]) &
+                      ((self.last_high[matched] > high[candidates]) |
+                       ((self.last_high[matched] == high[candidates]) &
+                        (self.last_low[matched] >= low[candidates]))))
+            if covers.all():
+                return match
+            match[candidates[~covers]] = self.parent[matched[~covers]]
+
+    def covering(self, prefixes: Iterable[str]) -> np.ndarray:
+        """ longest indexed prefix that covers each prefix, except itself """
+        keys = self._keys(np.asarray(prefixes, dtype=object))
+        match = self._longest_match(keys)
+        # a covering prefix of the same length is the prefix itself
+        itself = match >= 0
+        itself[itself] = self.length[match[itself]] == keys[3][itself]
+        match[itself] = self.parent[match[itself]]
+        return match
+
+    def more_specifics(
+            self, prefixes: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """ pairs of (position in prefixes, indexed prefix) for the indexed
+        prefixes that are more-specifics of each prefix """
+        version, high, low, length = self._keys(
+            np.asarray(prefixes, dtype=object))
+        last_high, last_low = self._last(version, high, low, length)
+        start = self._searchsorted([version, high, low, length + 1], "left")
+        end = self._searchsorted(
+            [version, last_high, last_low,
+             np.full(len(length), 129)], "right")
+        counts = np.maximum(end - start, 0)
+        query_ids = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.repeat(start - np.cumsum(counts) + counts, counts)
+        return query_ids, np.arange(counts.sum()) + offsets
+
+
 assert "5.57.81.0/24" == dec_v4_prefix(enc_v4_prefix("5.57.81.0/24"))
 assert "2001:1218::/32" == dec_v6_prefix(enc_v6_prefix("2001:1218::/32"))
 
+# batch encoders against enc_v4_prefix/enc_v6_prefix, /0 and host prefixes
+# set the highest bit (129th for IPv6)
+_v4_prefixes = [
+    "5.57.81.0/24", "0.0.0.0/0", "255.255.255.255/32", "128.0.0.0/1",
+    "10.0.0.0/8", "5.57.81.0/24"
+]
+assert (enc_v4_prefixes(_v4_prefixes).tolist() == [
+    enc_v4_prefix(prefix) for prefix in _v4_prefixes
+])
+assert (dec_v4_prefixes(enc_v4_prefixes(_v4_prefixes)).tolist() ==
+        _v4_prefixes)
+assert (dec_v4_prefixes(np.zeros(1, dtype=np.uint64)).tolist() == [None])
+_v6_prefixes = [
+    "2001:1218::/32", "::/0", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128",
+    "8000::/1", "2001:db8::1/128", "2001:db8:0:1::/64", "2001:db8::/63",
+    "::/128", "2001:1218::/32"
+]
+assert ([(int(top) << 128) | (int(high) << 64) | int(low)
+         for top, high, low in enc_v6_prefixes(_v6_prefixes).tolist()
+         ] == [enc_v6_prefix(prefix) for prefix in _v6_prefixes])
+assert (dec_v6_prefixes(enc_v6_prefixes(_v6_prefixes)).tolist() ==
+        _v6_prefixes)
+assert (dec_v6_prefixes(np.zeros(1, v6_prefix_dtype)).tolist() == [None])
+
 assert (get_AS_links_single([1, 2, 3, 4]) == [(1, 2), (2, 3), (3, 4)])
 assert (get_AS_links_single([3, 4]) == [(3, 4)])
 assert (get_AS_links_single([]) == [])
@@ -288,3 +1357,59 @@ assert (clean_ASpath([1, 2, 3, 4, 4, 4]) == [1, 2, 3, 4])
 
 assert (get_AS_links([[1, 2, 3, 4]]) == {(1, 2), (2, 3), (3, 4)})
 assert (get_AS_links([[1, 2]]) == {(1, 2)})
+
+# ASPaths against the per-path functions
+_paths = ["1 1 2 3 3 4", "", "5", "3 4 5", "2 2 2", "4 5 6 6"]
+_path_lists = [[int(asn) for asn in path.split()] for path in _paths]
+_batch = ASPaths.from_strings(_paths)
+assert ([_batch[i].tolist() for i in range(len(_batch))] == _path_lists)
+assert (_batch.lengths.tolist() == [len(path) for path in _path_lists])
+_batch = _batch.clean()
+_path_lists = [clean_ASpath(path) for path in _path_lists]
+assert ([_batch[i].tolist() for i in range(len(_batch))] == _path_lists)
+assert ([(tuple(link), path_id)
+         for link, path_id in zip(*[x.tolist() for x in _batch.links()])
+         ] == [(link, path_id) for path_id, path in enumerate(_path_lists)
+               for link in get_AS_links_single(path)])
+assert (set(map(tuple, _batch.unique_links().tolist())) == get_AS_links(
+    _path_lists))
+for _link in [(1, 2), (3, 4), (4, 3), (4, 5), (5, 6), (1, 3), (8, 9)]:
+    assert (_batch.paths_with_link(_link).tolist() == [
+        path_id for path_id, path in enumerate(_path_lists)
+        if link_on_path(_link, path)
+    ])
+    assert (_batch.contain_link(_link).tolist() == [
+        link_on_path(_link, path) for path in _path_lists
+    ])
+# links to AS sets are ignored
+assert (ASPaths.from_strings(["7 {8,9} 10", "7 8"]).unique_links().tolist() ==
+        [[7, 8]])
+
+# PrefixIndex against a scan of all indexed prefixes
+_index = PrefixIndex([
+    "10.1.2.0/24", "10.0.0.0/8", "10.1.0.0/16", "10.2.0.0/16", "0.0.0.0/0",
+    "192.168.0.0/16", "10.1.0.0/16", "2001:db8:1:2::/64", "2001:db8::/32",
+    "2001:db8:1::/48", "2001:db8::/48", "::/1"
+])
+_queries = list(_index.prefixes) + [
+    "10.1.2.128/25", "10.3.0.0/16", "10.0.0.0/7", "11.0.0.0/8",
+    "255.255.255.255/32", "2001:db8:1:2::1/128", "2001:db9::/32",
+    "2001:db8:2::/48", "8000::/1", "::/0"
+]
+_networks = [ipaddress.ip_network(prefix) for prefix in _index.prefixes]
+for _query, _match, _cover in zip(_queries, _index.longest_match(_queries),
+                                  _index.covering(_queries)):
+    _query = ipaddress.ip_network(_query)
+    _covering = [(network.prefixlen, i) for i, network in enumerate(_networks)
+                 if network.version == _query.version
+                 and _query.subnet_of(network)]
+    assert (_match == max(_covering, default=(0, -1))[1])
+    assert (_cover == max([(length, i) for length, i in _covering
+                           if length < _query.prefixlen],
+                          default=(0, -1))[1])
+assert (sorted(zip(*[x.tolist() for x in _index.more_specifics(_queries)])) ==
+        [(query_id, i) for query_id, query in enumerate(_queries)
+         for i, network in enumerate(_networks)
+         if network.version == ipaddress.ip_network(query).version
+         and network.subnet_of(ipaddress.ip_network(query))
+         and network != ipaddress.ip_network(query)])
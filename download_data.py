@@ -2,17 +2,66 @@ from collections import defaultdict
 from datetime import datetime as dt
 from tqdm import tqdm
 import bgpana as bap
+import mrt
+import asyncio
+import bz2
+import concurrent.futures
 import configparser
+import contextlib
+import gzip
+import hashlib
+import heapq
+import http.server
 import itertools
 import os
 import os.path
 import shutil
-import subprocess
 import sys
+import threading
+import urllib.error
+import urllib.request
 
 url_suffixes = None
-remove_route_collector_merge_files = True
 merge_route_collector_files = True
+# order of the merged dump: "time" merges all collectors into one timestamp
+# ordered stream, "collector" writes the collectors one after another (each
+# in timestamp order)
+merge_order = "time"
+# records per gzip member of the merged dump
+merge_block_lines = 10**6
+# records of a collector are sorted by timestamp within this many seconds
+# before they are merged; update files contain records from before their
+# interval, which is why get_url_suffixes starts 15 minutes early
+reorder_window = 15 * 60
+# write an index of the gzip members of the merged dumps, split_dumps_fast.py
+# uses it to split a dump in parallel (a time ordered dump only without
+# deduplicate there)
+write_block_index = True
+
+# archive locations, point them to fixture_server() for local tests
+url_bases = {
+    "routeviews": "http://archive.routeviews.org",
+    "isolario": "https://www.isolario.it/Isolario_MRT_data",
+    "ris": "http://data.ris.ripe.net"
+}
+# concurrent downloads per route collector project
+max_connections = {"routeviews": 8, "isolario": 4, "ris": 8}
+# a failed download is retried max_retries times, waiting
+# retry_backoff * 2**attempt seconds before each retry
+max_retries = 4
+retry_backoff = 2
+# concurrent bgpreader processes decoding downloaded files
+max_decoders = os.cpu_count()
+# "bgpreader" decodes with the external bgpreader, "python" with mrt.py in
+# max_decoders worker processes (BGP4MP update dumps only)
+decoder = "bgpreader"
+
+# downloaded files are kept in this cache (None disables it) and reused by
+# later runs with overlapping time windows; bgpreader filters are applied
+# when decoding, so the cache is independent of the config
+cache_dir = "download_cache"
+# size of the cache in bytes, least recently used files are evicted
+cache_size = 500 * 2**30
 
 
 def get_url_suffixes(start_ts, end_ts):
@@ -36,59 +85,485 @@ def get_url_suffixes(start_ts, end_ts):
     return url_suffixes
 
 
-def exec_command(command):
-    subprocess.Popen(command, shell=True).wait()
+def get_url(rc_project, rc, url_suffix):
+    # depending on the route rc-project we need a different URL format
+    if rc_project == "routeviews":
+        if rc == "route-views2":
+            rc_string = ""
+        else:
+            rc_string = f"/{rc}"
+        return f"{url_bases['routeviews']}{rc_string}/bgpdata/{url_suffix[0].replace('_', '.')}/UPDATES/updates.{url_suffix[1]}"
+
+    elif rc_project == "isolario":
+        return f"{url_bases['isolario']}/{rc}/{url_suffix[0]}/updates.{url_suffix[1]}"
+
+    elif rc_project == "ris":
+        return f"{url_bases['ris']}/{rc}/{url_suffix[0].replace('_', '.')}/updates.{url_suffix[1].replace('bz2', 'gz')}"
+
+
+def _fetch(url, filename):
+    """ downloads url to filename and validates it: the size has to match
+    the Content-Length and the file has to decompress without CRC errors.
+    Returns False if the file does not exist on the server. """
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response,\
+                open(filename, "wb") as raw_file:
+            shutil.copyfileobj(response, raw_file)
+            expected_size = response.headers.get("Content-Length")
+    except urllib.error.HTTPError as error:
+        if error.code == 404:
+            return False
+        raise
+    if expected_size is not None and os.path.getsize(filename) != int(
+            expected_size):
+        raise IOError(f"incomplete download: {url}")
+    compressed_open = bz2.open if filename.endswith("bz2") else gzip.open
+    with compressed_open(filename, "rb") as raw_file:
+        while raw_file.read(2**20):
+            pass
+    return True
+
+
+async def fetch(url, filename, connections):
+    """ downloads url with retries, returns False if it does not exist """
+    for attempt in range(max_retries + 1):
+        try:
+            async with connections:
+                return await asyncio.to_thread(_fetch, url, filename)
+        except Exception as error:
+            if attempt == max_retries:
+                raise
+            bap.log(f"retrying {url}: {error}")
+            await asyncio.sleep(retry_backoff * 2**attempt)
+
+
+async def decode(raw_filename, rc_project, rc, output_filename):
+    """ converts a downloaded MRT file to gzipped bgpreader records """
+    if decoder == "python":
+        await asyncio.get_running_loop().run_in_executor(
+            decoder_pool, mrt.decode_file, raw_filename, output_filename,
+            rc_project, rc, (int(start_ts), int(end_ts)), prefixes)
+        return
+    bgpreader_command = f"bgpreader {' '.join(bgpreader_arguments)} -d singlefile -o upd-file={raw_filename} 2> /dev/null | awk -F '|' '" + "{" + f"OFS = FS; $4=\"{rc_project}\"; $5=\"{rc}\"; print;" + "}'" + f"| gzip > {output_filename}"
+    # fail if any command of the pipe fails, not only gzip
+    process = await asyncio.create_subprocess_exec("bash", "-o", "pipefail",
+                                                   "-c", bgpreader_command)
+    if await process.wait() != 0:
+        raise IOError(f"decoding failed: {raw_filename}")
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as data_file:
+        while data := data_file.read(2**20):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    """ completion state of the segments in a download directory.
+
+    manifest.csv has a line <file>|<status>|<size>|<sha256> per decoded
+    segment file, appended when a segment is done (status "done") or does
+    not exist on the server ("missing"); later lines override earlier ones.
+    The first line holds the decoding filters, the manifest is discarded if
+    they changed. """
+
+    def __init__(self, directory, filters):
+        self.filename = f"{directory}/manifest.csv"
+        self.entries = dict()
+        if os.path.exists(self.filename):
+            with open(self.filename) as manifest:
+                if manifest.readline().rstrip('\n') == filters:
+                    for line in manifest:
+                        name, status, size, digest = line.rstrip(
+                            '\n').split('|')
+                        self.entries[name] = (status, int(size), digest)
+                else:
+                    bap.log(f"filters changed, discarding {self.filename}")
+        if not self.entries:
+            with open(self.filename, "w") as manifest:
+                manifest.write(filters + '\n')
+        # record() runs in worker threads
+        self.lock = threading.Lock()
+
+    def complete(self, filename):
+        """ True if the segment file is done and matches its size and
+        checksum """
+        entry = self.entries.get(os.path.basename(filename))
+        return (entry is not None and os.path.exists(filename)
+                and os.path.getsize(filename) == entry[1]
+                and file_sha256(filename) == entry[2])
+
+    def record(self, filename, status):
+        entry = (status, os.path.getsize(filename), file_sha256(filename))
+        with self.lock:
+            self.entries[os.path.basename(filename)] = entry
+            with open(self.filename, "a") as manifest:
+                manifest.write("|".join(
+                    [os.path.basename(filename), *map(str, entry)]) + '\n')
+
+
+class DownloadCache:
+    """ content-addressed cache of downloaded update files.
+
+    Files are stored once per content under objects/<sha256>, keys/<project>/
+    <collector>/<5 minute mark> holds the hash of the file fetched for that
+    key. A file's mtime is its last use, the least recently used files are
+    evicted when the cache grows beyond max_size. """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(f"{directory}/objects", exist_ok=True)
+        self.size = sum(
+            entry.stat().st_size
+            for entry in os.scandir(f"{directory}/objects"))
+        # put() runs in worker threads
+        self.lock = threading.Lock()
+
+    def _key_filename(self, rc_project, rc, url_suffix):
+        # the 5 minute mark of the file, without extension
+        return f"{self.directory}/keys/{rc_project}/{rc}/{url_suffix[1].split('.bz2')[0]}"
+
+    def get(self, rc_project, rc, url_suffix, filename):
+        """ links the cached file to filename, returns False if it is not
+        cached """
+        key_filename = self._key_filename(rc_project, rc, url_suffix)
+        if not os.path.exists(key_filename):
+            return False
+        object_filename = f"{self.directory}/objects/{open(key_filename).read()}"
+        try:
+            os.utime(object_filename)
+            os.link(object_filename, filename)
+        except FileNotFoundError:
+            # evicted
+            os.remove(key_filename)
+            return False
+        except OSError:
+            shutil.copyfile(object_filename, filename)
+        return True
+
+    def put(self, rc_project, rc, url_suffix, filename):
+        """ adds a downloaded file to the cache """
+        digest = file_sha256(filename)
+        object_filename = f"{self.directory}/objects/{digest}"
+        key_filename = self._key_filename(rc_project, rc, url_suffix)
+        with self.lock:
+            if not os.path.exists(object_filename):
+                shutil.copyfile(filename, object_filename + ".tmp")
+                os.replace(object_filename + ".tmp", object_filename)
+                self.size += os.path.getsize(object_filename)
+
+            os.makedirs(os.path.dirname(key_filename), exist_ok=True)
+            with open(key_filename, "w") as key_file:
+                key_file.write(digest)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """ removes least recently used files until the cache fits """
+        entries = sorted(os.scandir(f"{self.directory}/objects"),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+async def download_segments(rc_project, segments, manifest):
+    """ downloads and decodes the segments (rc, url_suffix, output file)
+    and records them in manifest. Downloads are limited to
+    max_connections[rc_project] at a time, the downloaded files are decoded
+    by max_decoders workers meanwhile. Returns the segments that could not
+    be downloaded or decoded. """
+    connections = asyncio.Semaphore(max_connections[rc_project])
+    # limit the downloaded files waiting for decoding
+    downloaded = asyncio.Queue(maxsize=2 * max_decoders)
+    failed = []
+    cache = DownloadCache(cache_dir,
+                          cache_size) if cache_dir is not None else None
+
+    async def download(rc, url_suffix, output_filename):
+        url = get_url(rc_project, rc, url_suffix)
+        raw_filename = output_filename + "." + url.rsplit('.', 1)[1]
+        if cache is not None and cache.get(rc_project, rc, url_suffix,
+                                           raw_filename):
+            await downloaded.put(
+                (rc, url_suffix, raw_filename, output_filename))
+            return
+        try:
+            if not await fetch(url, raw_filename, connections):
+                # the collector has no data for this interval
+                bap.log(f"does not exist: {url}")
+                open(output_filename, "wb").close()
+                manifest.record(output_filename, "missing")
+                return
+        except Exception as error:
+            bap.log(f"download failed: {url}: {error}")
+            failed.append((rc, url_suffix, output_filename))
+            return
+        if cache is not None:
+            await asyncio.to_thread(cache.put, rc_project, rc, url_suffix,
+                                    raw_filename)
+        await downloaded.put((rc, url_suffix, raw_filename, output_filename))
+
+    async def decoder():
+        while True:
+            rc, url_suffix, raw_filename, output_filename = await downloaded.get()
+            try:
+                await decode(raw_filename, rc_project, rc, output_filename)
+                await asyncio.to_thread(manifest.record, output_filename,
+                                        "done")
+            except Exception as error:
+                bap.log(f"{error}")
+                failed.append((rc, url_suffix, output_filename))
+            os.remove(raw_filename)
+            downloaded.task_done()
+
+    decoders = [asyncio.create_task(decoder()) for _ in range(max_decoders)]
+    await asyncio.gather(*[download(*segment) for segment in segments])
+    await downloaded.join()
+    for decoder_task in decoders:
+        decoder_task.cancel()
+    return failed
+
+
+@contextlib.contextmanager
+def fixture_server(directory, failures=None):
+    """ serves directory over HTTP on localhost, as a stand-in for the
+    archives in tests: point url_bases to the yielded URL and lay out the
+    fixture MRT files like the archive paths in get_url. failures maps URL
+    paths to the number of requests that fail (503) before the file is
+    served, to test retries. """
+    failures = dict(failures or {})
+    lock = threading.Lock()
+
+    class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def do_GET(self):
+            with lock:
+                fail = failures.get(self.path, 0) > 0
+                if fail:
+                    failures[self.path] -= 1
+            if fail:
+                self.send_error(503)
+            else:
+                super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
 
 
 def _download_dumps(rc_project, rc_names):
+    """ downloads and decodes the files of rc_project into a temporary
+    directory. The directory is kept if files failed, a re-run only fetches
+    the segments that are not complete in its manifest. """
     temporary_work_directory = f'.temp_download_{rc_project}.dump'
-    if os.path.exists(temporary_work_directory):
-        print("Caution! Temp dir already exists")
-        return
-    else:
-        os.mkdir(temporary_work_directory)
+    os.makedirs(temporary_work_directory, exist_ok=True)
+    manifest = DownloadManifest(
+        temporary_work_directory,
+        f"{decoder}|{start_ts}|{end_ts}|{','.join(prefixes)}")
 
     bap.log(f"{rc_project}: downloading files")
     global url_suffixes
-    commands = []
-    created_files = []
+    segments = []
     for rc in rc_names:
         for url_suffix in url_suffixes:
-            # depending on the route rc-project we need a different URL format
-            if rc_project == "routeviews":
-                if rc == "route-views2":
-                    rc_string = ""
-                else:
-                    rc_string = f"/{rc}"
-                url = f"http://archive.routeviews.org{rc_string}/bgpdata/{url_suffix[0].replace('_', '.')}/UPDATES/updates.{url_suffix[1]}"
-
-            elif rc_project == "isolario":
-                url = f"https://www.isolario.it/Isolario_MRT_data/{rc}/{url_suffix[0]}/updates.{url_suffix[1]}"
-
-            elif rc_project == "ris":
-                url = f"http://data.ris.ripe.net/{rc}/{url_suffix[0].replace('_', '.')}/updates.{url_suffix[1].replace('bz2', 'gz')}"
-
             # store files for later use here
             temp_file_name = f"{temporary_work_directory}/{rc}_{url_suffix[1]}".replace(
                 "bz2", "").strip()
+            segments.append((rc, url_suffix, temp_file_name))
 
-            bgpreader_command = f"bgpreader {' '.join(bgpreader_arguments)} -d singlefile -o upd-file={url} 2> /dev/null | awk -F '|' '" + "{" + f"OFS = FS; $4=\"{rc_project}\"; $5=\"{rc}\"; print;" + "}'" + f"| gzip > {temp_file_name}"
-
-            commands.append(bgpreader_command)
-            created_files.append(temp_file_name)
-
-    bap.paral(exec_command, [commands])
-
-    # merge files
-    # replace this part of the code if you don't want one huge file
-    bap.log(f"{rc_project}: merging files...")
-    output_filename = f"{rc_project}_{start_ts}_{end_ts}.dump.gz"
-    for file_ in created_files:
-        merge_command = f"cat {file_} >> {output_filename}"
-        subprocess.Popen(merge_command, shell=True).wait()
-    shutil.rmtree(temporary_work_directory)
-
-    return output_filename
+    missing = [
+        segment for segment in segments if not manifest.complete(segment[2])
+    ]
+    if len(missing) < len(segments):
+        bap.log(f"{rc_project}: {len(segments) - len(missing)} files "
+                "already downloaded")
+    failed = asyncio.run(download_segments(rc_project, missing, manifest))
+    if failed:
+        bap.log(f"{rc_project}: {len(failed)} files failed, e.g. " +
+                get_url(rc_project, *failed[0][:2]) +
+                ", run again to fetch only the failed files")
+    failed_files = set(output_filename for _, _, output_filename in failed)
+
+    # decoded files, merged by download_updates, and whether all succeeded
+    return [(rc_project, rc, file_) for rc, _, file_ in segments
+            if file_ not in failed_files], not failed
+
+
+def read_records(filename):
+    """ yields (ts, line) for the records of a decoded file """
+    with gzip.open(filename, "rb") as records:
+        for line in records:
+            yield float(line.split(b'|', 3)[2]), line
+
+
+def collector_records(collector, filenames):
+    """ yields (ts, line, collector) for the records of one collector in
+    timestamp order. Its files cover consecutive intervals, but records may
+    be up to reorder_window seconds older than records before them; they
+    are sorted in with a heap that holds the last reorder_window seconds.
+    Records of equal timestamp keep their order. """
+    pending = []
+    released = float("-inf")
+    late = 0
+    records = itertools.chain.from_iterable(
+        read_records(filename) for filename in filenames)
+    for sequence, (ts, line) in enumerate(records):
+        if ts < released:
+            late += 1
+        heapq.heappush(pending, (ts, sequence, line))
+        while pending[0][0] <= ts - reorder_window:
+            released, _, line = heapq.heappop(pending)
+            yield released, line, collector
+    while pending:
+        ts, _, line = heapq.heappop(pending)
+        yield ts, line, collector
+    if late:
+        bap.log(f"{collector[1]}: {late} records are more than "
+                f"{reorder_window} seconds out of order")
+
+
+def group_segments(segments):
+    """ maps (rc_project, rc) to the decoded files of the collector """
+    collector_files = defaultdict(list)
+    for rc_project, rc, filename in segments:
+        collector_files[(rc_project, rc)].append(filename)
+    return collector_files
+
+
+def collector_signature(filenames):
+    """ identifies the decoded files of a collector by name, size and
+    modification time """
+    return hashlib.sha256("|".join(
+        f"{os.path.basename(filename)},{os.path.getsize(filename)},{os.stat(filename).st_mtime_ns}"
+        for filename in filenames).encode()).hexdigest()
+
+
+def merged_blocks(collector_files, output_filename):
+    """ blocks (offset, length) per collector of a previous collector
+    ordered merge into output_filename whose decoded files did not change
+    since. Needs the block index of the previous merge. """
+    blocks = bap.read_block_index(output_filename)
+    if blocks is None or not os.path.exists(output_filename + ".merged"):
+        return dict()
+    if any(rc_project == "*" for _, _, rc_project, _ in blocks):
+        # merged in time order
+        return dict()
+    signatures = dict()
+    for line in open(output_filename + ".merged"):
+        rc_project, rc, signature = line.rstrip('\n').split('|')
+        signatures[(rc_project, rc)] = signature
+    unchanged = {
+        collector: []
+        for collector, filenames in collector_files.items()
+        if signatures.get(collector) == collector_signature(filenames)
+    }
+    for offset, length, rc_project, rc in blocks:
+        if (rc_project, rc) in unchanged:
+            unchanged[(rc_project, rc)].append((offset, length))
+    return unchanged
+
+
+def merge_records(segments):
+    """ merges the decoded files (rc_project, rc, filename) into one stream
+    of (ts, line, (rc_project, rc)) in merge_order. Only one file per
+    collector is open at a time, the collectors are merged with a heap. """
+    streams = [
+        collector_records(collector, filenames)
+        for collector, filenames in group_segments(segments).items()
+    ]
+    if merge_order == "collector":
+        return itertools.chain(*streams)
+    return heapq.merge(*streams, key=lambda record: record[0])
+
+
+def write_dump(segments, output_filename):
+    """ writes the merged records of segments to output_filename as gzip
+    members of up to merge_block_lines records, and their block index. In
+    collector order a block holds the records of a single collector, in
+    time order all blocks are marked as mixed (*).
+
+    In collector order, the blocks of collectors whose files did not change
+    since the last merge into output_filename are copied from it instead of
+    being merged again. """
+    collector_files = group_segments(segments)
+    previous_blocks = dict()
+    if merge_order == "collector" and os.path.exists(output_filename):
+        previous_blocks = merged_blocks(collector_files, output_filename)
+        if previous_blocks:
+            bap.log(f"reusing {len(previous_blocks)} collectors of "
+                    f"{output_filename}")
+
+    blocks = []
+    with open(output_filename + ".tmp", "wb") as output:
+
+        def write_block(data, collector):
+            blocks.append((output.tell(), len(data), *collector))
+            output.write(data)
+
+        def write_records(records):
+            lines = []
+            block_collector = None
+            for _, line, collector in records:
+                if merge_order != "collector":
+                    collector = ("*", "*")
+                if lines and (len(lines) == merge_block_lines
+                              or collector != block_collector):
+                    write_block(
+                        gzip.compress(b"".join(lines),
+                                      compresslevel=6,
+                                      mtime=0), block_collector)
+                    lines = []
+                block_collector = collector
+                lines.append(line)
+            if lines:
+                write_block(
+                    gzip.compress(b"".join(lines), compresslevel=6, mtime=0),
+                    block_collector)
+
+        if not previous_blocks:
+            write_records(merge_records(segments))
+        else:
+            with open(output_filename, "rb") as previous:
+                for collector, filenames in collector_files.items():
+                    if collector not in previous_blocks:
+                        write_records(collector_records(collector, filenames))
+                        continue
+                    for offset, length in previous_blocks[collector]:
+                        previous.seek(offset)
+                        write_block(previous.read(length), collector)
+    os.replace(output_filename + ".tmp", output_filename)
+
+    if write_block_index:
+        bap.write_block_index(output_filename, blocks)
+        # identifies the merged files for the next merge
+        with open(output_filename + ".merged", "w") as merged:
+            for collector, filenames in collector_files.items():
+                merged.write(
+                    f"{collector[0]}|{collector[1]}|{collector_signature(filenames)}\n"
+                )
+    else:
+        # an index of a previous merge does not describe this one
+        for suffix in [".index", ".merged"]:
+            if os.path.exists(output_filename + suffix):
+                os.remove(output_filename + suffix)
 
 
 def download_routeviews():
@@ -129,6 +604,7 @@ def download_updates(configfile):
     start_ts = config["general"]["start-ts"]
     global end_ts
     end_ts = config["general"]["end-ts"]
+    global prefixes
     prefixes = eval(config["general"]["prefixes"])
 
     # generate suffixes from timestamps
@@ -159,25 +635,33 @@ def download_updates(configfile):
         config.write(f)
 
     # download and filter data
-    isolario_output_file = download_isolario()
-    riperis_output_file = download_ripe_ris()
-    routeviews_output_file = download_routeviews()
-
-    # merge all route collectore files
+    global decoder_pool
+    with concurrent.futures.ProcessPoolExecutor(max_decoders) as decoder_pool:
+        downloads = {
+            "isolario": download_isolario(),
+            "ris": download_ripe_ris(),
+            "routeviews": download_routeviews()
+        }
+    segments = {
+        rc_project: project_segments
+        for rc_project, (project_segments, _) in downloads.items()
+    }
+
+    # merge all route collectore files in a single pass
+    bap.log("merging files...")
     if merge_route_collector_files:
-        merge_command = f"cat\
-                {isolario_output_file}\
-                {routeviews_output_file}\
-                {riperis_output_file}\
-                > {filename}"
-
-        subprocess.Popen(merge_command, shell=True).wait()
-
-    # remove other files
-    if remove_route_collector_merge_files:
-        os.remove(isolario_output_file)
-        os.remove(routeviews_output_file)
-        os.remove(riperis_output_file)
+        write_dump(list(itertools.chain(*segments.values())), filename)
+    else:
+        for rc_project, project_segments in segments.items():
+            write_dump(project_segments,
+                       f"{rc_project}_{start_ts}_{end_ts}.dump.gz")
+
+    # keep the downloads for the next run if files failed, it only fetches
+    # the failed files and merges again
+    if all(complete for _, complete in downloads.values()):
+        for rc_project in downloads:
+            shutil.rmtree(f'.temp_download_{rc_project}.dump',
+                          ignore_errors=True)
 
 
 if (__name__ == "__main__"):
@@ -2,115 +2,163 @@ import pandas as pd
 import time
 import bgpana as bap
 import os
+import gzip
+import shutil
+import numpy as np
 
 # ------------------------------------------------------------
-# this script is supposed to filter out duplicates per prefix 
-# WARNING: uses a lot of RAM, adjust num_cores according to your setup
+# this script is supposed to filter out duplicates per prefix
+# an update is a duplicate if it equals the previous update for the same
+# prefix in all columns except the timestamp. The files are streamed line by
+# line, only a fingerprint of the last update per prefix is kept in memory.
+# Empty fields are compared as values: an update that only adds or removes
+# e.g. communities is not a duplicate. The former pandas version treated
+# them as NA and dropped such updates, so its counts are lower.
 # ------------------------------------------------------------
 
 do_done_check = False
 
+# column positions in a *_dumps.gz file
+# message-type|upd-type|ts|rc-project|rc-name|peer-AS|peer-ip|prefix|next-hop|
+# path|origin-AS|communities|atomic-agg|agg-ip|agg-AS|med|isv6
+TS = 2
+PREFIX = 7
+AGG_AS = 14
+
+# column order of the *_no_dupes.gz files: everything but the timestamp,
+# prefix last, then the timestamp
+output_columns = [0, 1, 3, 4, 5, 6, 8, 9, 10, 11, 12, 13, 14, 15, 16, 7]
+
+
+def fingerprint(fields):
+    """ 64 bit fingerprint of the compared columns (all but ts) """
+    return hash((*fields[:TS], *fields[TS + 1:]))
+
+
+# column names of the columnar *_no_dupes.cols dumps, in output_columns order
+no_dupes_columns = [
+    "message-type", "upd-type", "rc-project", "rc-name", "peer-AS", "peer-ip",
+    "next-hop", "path", "origin-AS", "communities", "atomic-agg", "agg-ip",
+    "agg-AS", "med", "isv6", "prefix", "ts"
+]
+
+
+def filter_duplicate_columns(filename, save_filename):
+    """ filter_duplicates for a dump in columnar format (see
+    bap.DumpColumnsWriter), processed one part at a time. Values are
+    compared by their dictionary codes. """
+    if os.path.exists(save_filename):
+        shutil.rmtree(save_filename)
+
+    # fingerprint of the last update per prefix code
+    last_update = dict()
+    original_size = 0
+    without_dupes_size = 0
+    output = None
+    for part in range(bap.count_dump_parts(filename)):
+        df = bap.read_dump_columns(filename, no_dupes_columns, parts=[part])
+        original_size += df.shape[0]
+
+        # remove duplicates
+        codes = pd.DataFrame({
+            column: df[column].cat.codes
+            for column in no_dupes_columns if column != "ts"
+        })
+        df = df[~bap.find_duplicates(
+            codes["prefix"].to_numpy(np.uint64),
+            pd.util.hash_pandas_object(codes, index=False).to_numpy(),
+            last_update)]
+        without_dupes_size += df.shape[0]
+
+        # clean up agg-AS
+        df["agg-AS"] = df["agg-AS"].astype(str).str.strip()
+
+        if output is None:
+            output = bap.DumpColumnsWriter(save_filename)
+        output.write(df)
+
+    if output is None:
+        # for empty files
+        bap.log(f"empty file:\t {filename}")
+        return (0, 0)
+    output.close()
+    bap.log(f"done:\t {save_filename}")
+
+    # also save how many duplicates there were
+    return (original_size, without_dupes_size)
+
 
 def filter_duplicates(filename):
     global duplicate_absolutes
     bap.log(f"processing:\t {filename}")
 
     # check if already done
-    save_filename = f"{filename.replace('.gz', '_no_dupes.gz')}"
+    save_filename = f"{filename.replace('_dumps.', '_dumps_no_dupes.')}"
     if do_done_check:
-        if os.path.isfile(save_filename):
+        if os.path.exists(save_filename):
             bap.log(f"file exists:\t {filename}")
             return
 
-    try:
-        df = pd.read_csv(
-            filename,
-            sep='|',
-            header=None,
-            names=[
-                "message-type", "upd-type", "ts", "rc-project", "rc-name",
-                "peer-AS", "peer-ip", "prefix", "next-hop", "path",
-                "origin-AS", "communities", "atomic-agg", "agg-ip", "agg-AS",
-                "med", "isv6"
-            ],
-            dtype={
-                "message-type": "category",
-                "upd-type": "category",
-                "ts": "float",
-                "rc-project": "category",
-                "rc-name": "category",
-                "peer-AS": "category",
-                "peer-ip": "category",
-                "prefix": "string",
-                "next-hop": "category",
-                "path": "string",
-                "origin-AS": "string",
-                "communities": "string",
-                "atomic-agg": "category",
-                "agg-ip": "string",
-                "agg-AS": "string",
-                "med": "category",
-                "isv6": "category"
-            },
-        )
-        # nrows=100000)
-    except:
+    if filename.endswith(".cols"):
+        return filter_duplicate_columns(filename, save_filename)
+
+    # fingerprint of the last update per prefix
+    last_update = dict()
+    original_size = 0
+    without_dupes_size = 0
+    with gzip.open(filename, "rt") as dump:
+        output = None
+        for line in dump:
+            fields = line.rstrip('\n').split('|')
+            original_size += 1
+
+            # remove duplicates
+            update = fingerprint(fields)
+            if last_update.get(fields[PREFIX]) == update:
+                continue
+            last_update[fields[PREFIX]] = update
+            without_dupes_size += 1
+
+            # clean up agg-AS
+            fields[AGG_AS] = fields[AGG_AS].strip()
+            # timestamps are written as floats like before
+            fields[TS] = repr(float(fields[TS]))
+
+            if output is None:
+                output = gzip.open(save_filename, "wt")
+            output.write('|'.join([fields[i] for i in output_columns] +
+                                  [fields[TS]]) + '\n')
+
+    if output is None:
         # for empty files
         bap.log(f"empty file:\t {filename}")
         return (0, 0)
-
-    # save original update count for later
-    original_size = df.shape[0]
-
-    # fill all na values with an empty string, because None does not equal None
-    for column_name in df.columns.tolist():
-        if df[column_name].dtype.name == "category":
-            df[column_name] = df[column_name].cat.add_categories([""
-                                                                  ]).fillna("")
-
-    # remove duplicates
-    df["original_order"] = pd.Series(range(0, df.shape[0]))
-    df = df.sort_values(by=["prefix", "original_order"])
-    compare_columns = [
-        "message-type", "upd-type", "rc-project", "rc-name", "peer-AS",
-        "peer-ip", "next-hop", "path", "origin-AS", "communities",
-        "atomic-agg", "agg-ip", "agg-AS", "med", "isv6", "prefix"
-    ]
-    df = df[~(df[compare_columns] == df[compare_columns].shift(1)).all(axis=1)]
-    df = df.set_index("original_order")
-    df = df.sort_index()
-
-    # take only necessary columns
-    df = df[[
-        "message-type", "upd-type", "rc-project", "rc-name", "peer-AS",
-        "peer-ip", "next-hop", "path", "origin-AS", "communities",
-        "atomic-agg", "agg-ip", "agg-AS", "med", "isv6", "prefix", "ts"
-    ]]
-
-    # also save how many duplicates there were
-    without_dupes_size = df.shape[0]
-    dupes_count = (original_size, without_dupes_size)
-
-    # clean up agg-AS
-    df["agg-AS"] = df["agg-AS"].str.strip()
-
-    # save no_duplicates_file
-    df.to_csv(save_filename,
-              sep='|',
-              header=None,
-              index=False,
-              compression="gzip")
+    output.close()
     bap.log(f"done:\t {save_filename}")
 
-    return dupes_count
+    # also save how many duplicates there were
+    return (original_size, without_dupes_size)
 
 
 dirname = "split_dump_raw"
 filenames = [
     f"{dirname}/{name}" for name in os.listdir(dirname) if "dupe" not in name
 ]
-dupe_res = bap.paral(filter_duplicates, [filenames], num_cores=10)
-# saves portion of duplicates
-pd.Series(dict(zip(filenames, dupe_res))).to_csv("duplicate_absolutes.csv",
-                                                 sep='|',
-                                                 header=None)
+if filenames:
+    # largest files first, so that they do not finish last
+    dupe_res = bap.paral(filter_duplicates, [filenames],
+                         costs=[
+                             os.path.getsize(filename)
+                             if os.path.isfile(filename) else sum(
+                                 entry.stat().st_size
+                                 for entry in os.scandir(filename))
+                             for filename in filenames
+                         ])
+    # saves portion of duplicates
+    pd.Series(dict(zip(filenames,
+                       dupe_res))).to_csv("duplicate_absolutes.csv",
+                                          sep='|',
+                                          header=None)
+else:
+    # split_dumps_fast.py already removed the duplicates
+    bap.log("no dumps with duplicates found")
@@ -0,0 +1,335 @@
+import bz2
+import gzip
+import ipaddress
+import struct
+
+# ------------------------------------------------------------
+# decodes BGP4MP update dumps (RFC 6396) into the records that bgpreader
+# prints, so that downloaded files can be converted without bgpreader:
+# <dump-type>|<elem-type>|<record-ts>|<project>|<collector>|<router-name>|<router-ip>|<peer-ASn>|<peer-IP>|<prefix>|<next-hop-IP>|<AS-path>|<origin-AS>|<communities>|<old-state>|<new-state>|atomic-agg|agg-ip|agg-asn|med
+# ------------------------------------------------------------
+
+BGP4MP = 16
+BGP4MP_ET = 17
+
+# BGP4MP subtypes
+STATE_CHANGE = 0
+MESSAGE = 1
+MESSAGE_AS4 = 4
+STATE_CHANGE_AS4 = 5
+MESSAGE_LOCAL = 6
+MESSAGE_AS4_LOCAL = 7
+MESSAGE_ADDPATH = 8
+MESSAGE_AS4_ADDPATH = 9
+MESSAGE_LOCAL_ADDPATH = 10
+MESSAGE_AS4_LOCAL_ADDPATH = 11
+
+# subtypes with 4 byte AS numbers and with path identifiers in the NLRI
+as4_subtypes = {
+    MESSAGE_AS4, STATE_CHANGE_AS4, MESSAGE_AS4_LOCAL, MESSAGE_AS4_ADDPATH,
+    MESSAGE_AS4_LOCAL_ADDPATH
+}
+addpath_subtypes = {
+    MESSAGE_ADDPATH, MESSAGE_AS4_ADDPATH, MESSAGE_LOCAL_ADDPATH,
+    MESSAGE_AS4_LOCAL_ADDPATH
+}
+message_subtypes = {
+    MESSAGE, MESSAGE_AS4, MESSAGE_LOCAL, MESSAGE_AS4_LOCAL, MESSAGE_ADDPATH,
+    MESSAGE_AS4_ADDPATH, MESSAGE_LOCAL_ADDPATH, MESSAGE_AS4_LOCAL_ADDPATH
+}
+
+BGP_UPDATE = 2
+
+# path attribute types
+ORIGIN = 1
+AS_PATH = 2
+NEXT_HOP = 3
+MULTI_EXIT_DISC = 4
+ATOMIC_AGGREGATE = 6
+AGGREGATOR = 7
+COMMUNITIES = 8
+MP_REACH_NLRI = 14
+MP_UNREACH_NLRI = 15
+AS4_PATH = 17
+AS4_AGGREGATOR = 18
+
+AS_SET = 1
+
+AFI_IPV4 = 1
+AFI_IPV6 = 2
+
+peer_states = [
+    "unknown", "idle", "connect", "active", "opensent", "openconfirm",
+    "established"
+]
+
+
+def open_dump(filename):
+    """ opens a (bz2 or gzip compressed) MRT file """
+    if filename.endswith("bz2"):
+        return bz2.open(filename, "rb")
+    if filename.endswith("gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def iter_records(data):
+    """ yields (ts, type, subtype, body) for the MRT records in data """
+    view = memoryview(data)
+    offset = 0
+    while offset + 12 <= len(view):
+        ts, mrt_type, subtype, length = struct.unpack_from(">IHHI", view, offset)
+        offset += 12
+        body = view[offset:offset + length]
+        offset += length
+        if mrt_type == BGP4MP_ET:
+            # microsecond timestamp, bgpreader prints seconds
+            body = body[4:]
+            mrt_type = BGP4MP
+        yield ts, mrt_type, subtype, body
+
+
+def decode_ip(data, afi):
+    if afi == AFI_IPV4:
+        return ".".join(map(str, data[:4].tolist()))
+    return ipaddress.IPv6Address(bytes(data[:16])).compressed
+
+
+def decode_prefixes(data, afi, addpath):
+    """ decodes NLRI (or withdrawn routes) into prefix strings """
+    prefixes = []
+    size = 4 if afi == AFI_IPV4 else 16
+    offset = 0
+    while offset < len(data):
+        if addpath:
+            offset += 4
+        length = data[offset]
+        octets = (length + 7) // 8
+        address = bytes(data[offset + 1:offset + 1 + octets]).ljust(
+            size, b"\0")
+        offset += 1 + octets
+        if afi == AFI_IPV4:
+            prefixes.append(".".join(map(str, address)) + f"/{length}")
+        else:
+            prefixes.append(
+                f"{ipaddress.IPv6Address(address).compressed}/{length}")
+    return prefixes
+
+
+def decode_as_path(data, as_size):
+    """ decodes AS_PATH/AS4_PATH into a list of segments (type, [asns]) """
+    segments = []
+    offset = 0
+    asn_format = ">%dI" if as_size == 4 else ">%dH"
+    while offset + 2 <= len(data):
+        segment_type, count = data[offset], data[offset + 1]
+        asns = list(
+            struct.unpack_from(asn_format % count, data, offset + 2))
+        offset += 2 + count * as_size
+        segments.append((segment_type, asns))
+    return segments
+
+
+def merge_as4_path(segments, as4_segments):
+    """ reconstructs the path of a 2 byte AS session (RFC 6793 4.2.3) """
+
+    def path_length(segments):
+        return sum(1 if segment_type == AS_SET else len(asns)
+                   for segment_type, asns in segments)
+
+    keep = path_length(segments) - path_length(as4_segments)
+    if keep < 0:
+        return segments
+    merged = []
+    for segment_type, asns in segments:
+        if keep <= 0:
+            break
+        if segment_type == AS_SET:
+            merged.append((segment_type, asns))
+            keep -= 1
+        else:
+            merged.append((segment_type, asns[:keep]))
+            keep -= len(asns[:keep])
+    return merged + as4_segments
+
+
+def format_as_path(segments):
+    """ path and origin AS as printed by bgpreader, sets as {a,b} """
+    hops = []
+    for segment_type, asns in segments:
+        if segment_type == AS_SET:
+            hops.append("{" + ",".join(map(str, asns)) + "}")
+        else:
+            hops += map(str, asns)
+    return " ".join(hops), hops[-1] if hops else ""
+
+
+def decode_update(message, as_size, addpath):
+    """ returns (withdrawn prefixes, announced prefixes, fields) of a BGP
+    UPDATE message, fields are the per-announcement record fields
+    (next-hop, AS-path, origin-AS, communities, atomic-agg, agg-ip, agg-asn,
+    med) for IPv4 and IPv6 announcements """
+    withdrawn_length = struct.unpack_from(">H", message, 0)[0]
+    withdrawn = decode_prefixes(message[2:2 + withdrawn_length], AFI_IPV4,
+                                addpath)
+    offset = 2 + withdrawn_length
+    attributes_length = struct.unpack_from(">H", message, offset)[0]
+    offset += 2
+    attributes_end = offset + attributes_length
+
+    announced = []
+    next_hops = {AFI_IPV4: ""}
+    segments = []
+    as4_segments = None
+    communities = ""
+    atomic_aggregate = ""
+    aggregator_ip = ""
+    aggregator_asn = ""
+    med = ""
+    while offset < attributes_end:
+        flags, attribute_type = message[offset], message[offset + 1]
+        if flags & 0x10:
+            length = struct.unpack_from(">H", message, offset + 2)[0]
+            offset += 4
+        else:
+            length = message[offset + 2]
+            offset += 3
+        value = message[offset:offset + length]
+        offset += length
+
+        if attribute_type == AS_PATH:
+            segments = decode_as_path(value, as_size)
+        elif attribute_type == AS4_PATH:
+            as4_segments = decode_as_path(value, 4)
+        elif attribute_type == NEXT_HOP:
+            next_hops[AFI_IPV4] = decode_ip(value, AFI_IPV4)
+        elif attribute_type == MULTI_EXIT_DISC:
+            med = str(struct.unpack_from(">I", value)[0])
+        elif attribute_type == ATOMIC_AGGREGATE:
+            atomic_aggregate = "AG"
+        elif attribute_type in (AGGREGATOR, AS4_AGGREGATOR):
+            asn_size = 4 if attribute_type == AS4_AGGREGATOR else len(
+                value) - 4
+            asn = int.from_bytes(value[:asn_size], "big")
+            # AS_TRANS is replaced by AS4_AGGREGATOR
+            if attribute_type == AS4_AGGREGATOR or aggregator_asn == "":
+                aggregator_asn = str(asn)
+                aggregator_ip = decode_ip(value[asn_size:], AFI_IPV4)
+        elif attribute_type == COMMUNITIES:
+            communities = " ".join(
+                f"{value[i] << 8 | value[i + 1]}:{value[i + 2] << 8 | value[i + 3]}"
+                for i in range(0, len(value) - 3, 4))
+        elif attribute_type == MP_REACH_NLRI:
+            afi = struct.unpack_from(">H", value)[0]
+            next_hop_length = value[3]
+            next_hops[afi] = decode_ip(value[4:4 + next_hop_length], afi)
+            announced += [(afi, prefix) for prefix in decode_prefixes(
+                value[5 + next_hop_length:], afi, addpath)]
+        elif attribute_type == MP_UNREACH_NLRI:
+            afi = struct.unpack_from(">H", value)[0]
+            withdrawn += decode_prefixes(value[3:], afi, addpath)
+
+    announced += [(AFI_IPV4, prefix) for prefix in decode_prefixes(
+        message[attributes_end:], AFI_IPV4, addpath)]
+
+    if as4_segments is not None and as_size == 2:
+        segments = merge_as4_path(segments, as4_segments)
+    path, origin_asn = format_as_path(segments)
+    announced = [(prefix,
+                  [next_hops.get(afi, ""), path, origin_asn, communities,
+                   atomic_aggregate, aggregator_ip, aggregator_asn, med])
+                 for afi, prefix in announced]
+    return withdrawn, announced
+
+
+def prefix_filter(prefixes):
+    """ returns a function that tells if a prefix overlaps with any of
+    prefixes (like bgpreader -k), None if prefixes is empty """
+    if not prefixes:
+        return None
+    networks = [ipaddress.ip_network(prefix) for prefix in prefixes]
+
+    def overlaps(prefix):
+        network = ipaddress.ip_network(prefix)
+        return any(network.version == other.version and (
+            network.subnet_of(other) or other.subnet_of(network))
+                   for other in networks)
+
+    return overlaps
+
+
+def decode_records(data, rc_project="", rc="", window=None, prefixes=None):
+    """ yields the bgpreader records (lists of 20 strings) of the BGP4MP
+    updates and state changes in data.
+
+    window is an inclusive (start, end) filter on the record timestamp and
+    prefixes a list of prefixes that announcements and withdrawals have to
+    overlap with, like bgpreader -w and -k. """
+    overlaps = prefix_filter(prefixes)
+    for ts, mrt_type, subtype, body in iter_records(data):
+        if mrt_type != BGP4MP:
+            continue
+        if window is not None and not window[0] <= ts <= window[1]:
+            continue
+
+        as_size = 4 if subtype in as4_subtypes else 2
+        peer_asn = int.from_bytes(body[:as_size], "big")
+        afi = struct.unpack_from(">H", body, 2 * as_size + 2)[0]
+        ip_size = 4 if afi == AFI_IPV4 else 16
+        offset = 2 * as_size + 4
+        peer_ip = decode_ip(body[offset:offset + ip_size], afi)
+        offset += 2 * ip_size
+        header = ["U", "", str(ts), rc_project, rc, "", "", str(peer_asn),
+                  peer_ip]
+
+        if subtype in (STATE_CHANGE, STATE_CHANGE_AS4):
+            old_state, new_state = struct.unpack_from(">HH", body, offset)
+            record = header + [""] * 11
+            record[1] = "S"
+            record[14] = peer_states[old_state] if old_state < len(
+                peer_states) else str(old_state)
+            record[15] = peer_states[new_state] if new_state < len(
+                peer_states) else str(new_state)
+            yield record
+            continue
+
+        if subtype not in message_subtypes:
+            continue
+        # skip the marker of the BGP message
+        message = body[offset + 16:]
+        if len(message) < 3 or message[2] != BGP_UPDATE:
+            continue
+        withdrawn, announced = decode_update(message[3:], as_size,
+                                             subtype in addpath_subtypes)
+
+        for prefix in withdrawn:
+            if overlaps is None or overlaps(prefix):
+                record = header + [prefix] + [""] * 10
+                record[1] = "W"
+                yield record
+        for prefix, fields in announced:
+            if overlaps is None or overlaps(prefix):
+                record = header + [prefix] + fields[:4] + ["", ""
+                                                           ] + fields[4:]
+                record[1] = "A"
+                yield record
+
+
+def decode_file(filename,
+                output_filename,
+                rc_project,
+                rc,
+                window=None,
+                prefixes=None,
+                batch_size=100000):
+    """ decodes an MRT file into a gzipped file of bgpreader records """
+    with open_dump(filename) as dump:
+        data = dump.read()
+    with gzip.open(output_filename, "wb") as output:
+        lines = []
+        for record in decode_records(data, rc_project, rc, window, prefixes):
+            lines.append("|".join(record) + "\n")
+            if len(lines) == batch_size:
+                output.write("".join(lines).encode())
+                lines = []
+        output.write("".join(lines).encode())
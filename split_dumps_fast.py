@@ -6,6 +6,16 @@ import configparser
 import gzip
 import os
 import time
+import numpy as np
+import multiprocessing
+import multiprocessing.connection
+import zlib
+import io
+import itertools
+import shutil
+import queue
+from collections import OrderedDict, defaultdict
+from multiprocessing import shared_memory, resource_tracker
 
 # ------------------------------------------------------------
 # Note that this does not work if the route collector column
@@ -24,62 +34,544 @@ split_dir = "split_dump_raw"
 # complete update dump
 input_file = config["general"]["input-file"]
 
+# drop duplicates (see filter_duplicates.py) while splitting and write the
+# *_dumps_no_dupes.gz files and duplicate_absolutes.csv directly, so that the
+# un-deduplicated per-VP files are never written
+deduplicate = False
+
+# format of the per-VP files: "gzip" writes pipe-separated *_dumps.gz files,
+# "columns" writes *_dumps.cols directories in the columnar format of
+# bap.DumpColumnsWriter, which filter_duplicates.py and track_penalty.py
+# read as well
+output_format = "gzip"
+
+# number of writer processes, each one owns the output files whose name
+# hashes to it and keeps them open for the whole run
+num_writers = 8
+# open output files per writer, the least recently used one is closed when
+# a writer needs more
+max_open_files = 256
+
+# number of processes that parse the input file in parallel, only used if
+# download_data.py wrote a block index for it (write_block_index). A time
+# ordered dump (merge_order = "time") is only split in parallel without
+# deduplicate, which needs all updates of a VP in one reader; use
+# merge_order = "collector" to deduplicate in parallel.
+num_readers = 8
+# uncompressed bytes a reader parses at once
+reader_batch_size = 2 * 10**9
+
 # create split dir if it does not exist
 bap.prep_dir(split_dir)
 
 # <dump-type>|<elem-type>|<record-ts>|<project>|<collector>|||<peer-ASn>|<peer-IP>|<prefix>|<next-hop-IP>|<AS-path>|<origin-AS>|<communities>|<old-state>|<new-state>|atomic-agg|agg-ip|agg-asn|med
 
 
-def print_to_file(chunk):
-    group_id, df_group = chunk
-    peer_ip, rc, version = group_id
+def get_filename(peer_ip, rc, version):
+    extension = "cols" if output_format == "columns" else "gz"
     if version:
-        filename = f"{split_dir}/{peer_ip}_{rc}_v6_dumps.gz"
-    else:
-        filename = f"{split_dir}/{peer_ip}_{rc}_v4_dumps.gz"
-    file_handle = gzip.open(filename, "a+")
-    file_handle.write(
-        df_group.to_csv(sep='|', header=None, index=False).encode())
+        return f"{split_dir}/{peer_ip}_{rc}_v6_dumps.{extension}"
+    return f"{split_dir}/{peer_ip}_{rc}_v4_dumps.{extension}"
 
 
-def main():
-    # for the 2020 dataset the below chunksize was fastest
-    # chunksize = 5 * 10**7
-    chunksize = 10**7
-    lines_processed = 0
-    for df_chunk in pd.read_csv(
-            input_file,
-            sep='|',
-            header=None,
-            names=[
-                "message-type", "upd-type", "ts", "rc-project", "rc-name",
-                "router-name", "router-ip", "peer-AS", "peer-ip", "prefix",
-                "next-hop", "path", "origin-AS", "communities", "old-state",
-                "new-state", "atomic-agg", "agg-ip", "agg-AS", "med"
-            ],
-            usecols=[
-                "message-type", "upd-type", "ts", "rc-project", "rc-name",
-                "peer-AS", "peer-ip", "prefix", "next-hop", "path",
-                "origin-AS", "communities", "atomic-agg", "agg-ip", "agg-AS",
-                "med"
+def write_shards(shard_queue, done_queues):
+    """ writer process: appends the batches it receives to their output
+    files until it receives None. A batch is either a DataFrame (columnar
+    files) or a line range (name, start, stop, producer) of a chunk in
+    shared memory; (name, None, None, producer) releases the chunk. """
+    open_files = OrderedDict()
+    shared_chunks = dict()
+    while True:
+        batch = shard_queue.get()
+        if batch is None:
+            break
+        filename, lines = batch
+
+        if isinstance(lines, tuple):
+            name, start, stop, producer = lines
+            if start is None:
+                shared_chunks.pop(name).close()
+                done_queues[producer].put(name)
+                continue
+            if name not in shared_chunks:
+                shared_chunks[name] = shared_memory.SharedMemory(name)
+                # the producer unlinks the chunk, attaching must not register
+                # it a second time
+                resource_tracker.unregister(shared_chunks[name]._name,
+                                            "shared_memory")
+            lines = shared_chunks[name].buf[start:stop]
+
+        if filename in open_files:
+            open_files.move_to_end(filename)
+        else:
+            if len(open_files) == max_open_files:
+                open_files.popitem(last=False)[1].close()
+            if filename.endswith(".cols"):
+                open_files[filename] = bap.DumpColumnsWriter(filename)
+            else:
+                open_files[filename] = gzip.open(filename, "ab")
+        open_files[filename].write(lines)
+        del lines
+    for file_handle in open_files.values():
+        file_handle.close()
+
+
+class ShardWriterPool:
+    """ long-lived writer processes, output files are hash-partitioned
+    between them so that every file is written by a single process.
+
+    Serialized chunks are handed over in shared memory, the writers only
+    receive the line range of each of their files. Every process that
+    writes to the pool (producer) gets its own queue for the writers to
+    confirm that they are done with a chunk. """
+
+    def __init__(self, num_writers, num_producers=1):
+        self.queues = [
+            multiprocessing.Queue(maxsize=64) for _ in range(num_writers)
+        ]
+        self.done_queues = [
+            multiprocessing.Queue() for _ in range(num_producers)
+        ]
+        self.writers = [
+            multiprocessing.Process(target=write_shards,
+                                    args=(shard_queue, self.done_queues),
+                                    daemon=True)
+            for shard_queue in self.queues
+        ]
+        for writer in self.writers:
+            writer.start()
+
+        # chunks of this producer in shared memory: [shared memory, number
+        # of writers that still use it]
+        self.shared_chunks = OrderedDict()
+
+    def _get_writer(self, filename):
+        return zlib.crc32(filename.encode()) % len(self.queues)
+
+    def _check_writer(self, writer):
+        # writers only stop on None, the sentinel tells whether one stopped
+        # in the producer processes as well, which cannot query the exit
+        # code of their siblings
+        if multiprocessing.connection.wait([self.writers[writer].sentinel],
+                                           timeout=0):
+            raise RuntimeError(f"shard writer {writer} stopped unexpectedly")
+
+    def _put(self, writer, batch):
+        # a dead writer never empties its queue, check it while waiting
+        while True:
+            try:
+                self.queues[writer].put(batch, timeout=1)
+                return
+            except queue.Full:
+                self._check_writer(writer)
+
+    def write(self, filename, lines):
+        self._put(self._get_writer(filename), (filename, lines))
+
+    def write_shared(self, data, shards, producer=0):
+        """ writes the line ranges (filename, start, stop) of data """
+        chunk = shared_memory.SharedMemory(create=True, size=len(data))
+        chunk.buf[:len(data)] = data
+        writers = set()
+        for filename, start, stop in shards:
+            writer = self._get_writer(filename)
+            self._put(writer, (filename, (chunk.name, start, stop, producer)))
+            writers.add(writer)
+        for writer in writers:
+            self._put(writer, ("", (chunk.name, None, None, producer)))
+        self.shared_chunks[chunk.name] = [chunk, len(writers)]
+
+        # parse the next chunk while this one is written
+        while len(self.shared_chunks) > 1:
+            self._release_oldest(producer)
+
+    def _release_oldest(self, producer):
+        oldest = next(iter(self.shared_chunks))
+        while self.shared_chunks[oldest][1] > 0:
+            try:
+                name = self.done_queues[producer].get(timeout=1)
+            except queue.Empty:
+                for writer in range(len(self.writers)):
+                    self._check_writer(writer)
+                continue
+            self.shared_chunks[name][1] -= 1
+        chunk = self.shared_chunks.pop(oldest)[0]
+        chunk.close()
+        chunk.unlink()
+
+    def flush(self, producer=0):
+        """ waits until the writers are done with the chunks of producer """
+        while self.shared_chunks:
+            self._release_oldest(producer)
+
+    def close(self):
+        self.flush()
+        for writer in range(len(self.writers)):
+            self._put(writer, None)
+        for writer in self.writers:
+            writer.join()
+        for number, writer in enumerate(self.writers):
+            if writer.exitcode != 0:
+                raise RuntimeError(f"shard writer {number} failed with exit "
+                                   f"code {writer.exitcode}")
+
+
+def record_sizes(df_chunk):
+    """ size of each update in the pipe-separated format """
+    sizes = np.full(df_chunk.shape[0], df_chunk.shape[1], dtype=np.int64)
+    for column in df_chunk.columns:
+        sizes += df_chunk[column].fillna("").astype(str).str.len().to_numpy(
+            np.int64)
+    return sizes
+
+
+def print_to_files(writer_pool, df_chunk, producer=0):
+    """ sends the updates of a chunk to the writers of their VP files,
+    returns the size of each update in bytes """
+    # group by peer, route collector, and IP version
+    df_chunk_groups = df_chunk.groupby(["peer-ip", "rc-name", "version"])
+    filenames = [
+        get_filename(*group_id) for group_id in df_chunk_groups.groups
+    ]
+    if deduplicate:
+        filenames = [
+            filename.replace("_dumps.", "_dumps_no_dupes.")
+            for filename in filenames
+        ]
+        df_chunk = df_chunk.drop(columns="version")
+
+    if output_format == "columns":
+        for filename, (_, df_group) in zip(filenames, df_chunk_groups):
+            if deduplicate:
+                # drop_duplicates already added isv6
+                df_group = df_group.drop(columns="version")
+            else:
+                df_group = df_group.rename(columns={"version": "isv6"})
+            writer_pool.write(filename, df_group)
+        return record_sizes(df_chunk)
+
+    # serialize the chunk once, sorted by group so that every group is a
+    # contiguous range of lines
+    group_codes = df_chunk_groups.ngroup().to_numpy()
+    order = np.argsort(group_codes, kind="stable")
+    order = order[group_codes[order] >= 0]
+    data = df_chunk.take(order).to_csv(sep='|', header=None,
+                                       index=False).encode()
+    sizes = np.zeros(df_chunk.shape[0], dtype=np.int64)
+    if not data:
+        return sizes
+    line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord(
+        '\n')) + 1
+    sizes[order] = np.diff(line_ends, prepend=0)
+    group_ends = line_ends[np.cumsum(df_chunk_groups.size().to_numpy()) -
+                           1].tolist()
+    writer_pool.write_shared(
+        data, zip(filenames, [0] + group_ends[:-1], group_ends), producer)
+    return sizes
+
+
+# columns compared by the duplicate filter and column order of the
+# *_no_dupes.gz files
+compare_columns = [
+    "message-type", "upd-type", "rc-project", "rc-name", "peer-AS", "peer-ip",
+    "next-hop", "path", "origin-AS", "communities", "atomic-agg", "agg-ip",
+    "agg-AS", "med", "isv6", "prefix"
+]
+
+# fingerprint of the last update per (peer-ip, rc-name, prefix) hash
+last_update = dict()
+
+
+def drop_duplicates(df_chunk):
+    """ removes updates that equal the previous update for the same prefix
+    of the same VP in all compare_columns. The previous update may be in an
+    earlier chunk. Returns the remaining updates in no_dupes format. """
+    df_chunk = df_chunk.fillna("")
+    df_chunk["isv6"] = df_chunk["version"].astype(str)
+    keys = pd.util.hash_pandas_object(df_chunk[["peer-ip", "rc-name",
+                                                "prefix"]],
+                                      index=False).to_numpy()
+    updates = pd.util.hash_pandas_object(df_chunk[compare_columns],
+                                         index=False).to_numpy()
+
+    df_chunk = df_chunk[~bap.find_duplicates(keys, updates, last_update)]
+
+    df_chunk["agg-AS"] = df_chunk["agg-AS"].str.strip()
+    df_chunk["ts"] = df_chunk["ts"].astype(float)
+    return df_chunk[compare_columns + ["ts", "version"]]
+
+
+# columns of the bgpreader output, see above
+read_csv_arguments = dict(
+    sep='|',
+    header=None,
+    names=[
+        "message-type", "upd-type", "ts", "rc-project", "rc-name",
+        "router-name", "router-ip", "peer-AS", "peer-ip", "prefix",
+        "next-hop", "path", "origin-AS", "communities", "old-state",
+        "new-state", "atomic-agg", "agg-ip", "agg-AS", "med"
+    ],
+    usecols=[
+        "message-type", "upd-type", "ts", "rc-project", "rc-name", "peer-AS",
+        "peer-ip", "prefix", "next-hop", "path", "origin-AS", "communities",
+        "atomic-agg", "agg-ip", "agg-AS", "med"
+    ],
+    dtype=str)
+
+
+# columns of the rc_mapping files, plus the number of updates and their size
+# in bytes in the VP file
+catalog_columns = ["rc-project", "rc-name", "peer-AS", "peer-ip"]
+
+
+def update_catalog(peer_catalog, df_chunk, sizes):
+    """ adds the updates of a chunk to the (updates, bytes) per VP and IP
+    version in peer_catalog """
+    counts = pd.DataFrame({
+        "updates": 1,
+        "bytes": sizes
+    },
+                          index=df_chunk.index).groupby(
+                              [df_chunk[column].fillna("")
+                               for column in catalog_columns] +
+                              [df_chunk["version"]]).sum()
+    for peer, (updates, size) in zip(counts.index, counts.to_numpy()):
+        previous_updates, previous_size = peer_catalog.get(peer, (0, 0))
+        peer_catalog[peer] = (previous_updates + int(updates),
+                              previous_size + int(size))
+
+
+def write_rc_mapping(peer_catalog):
+    """ writes the VPs per IP version to rc_mapping_v4 and rc_mapping_v6
+    as rc-project|rc-name|peer-AS|peer-ip|updates|bytes, replaces
+    create_rc_mapping.sh """
+    for version, name in [(False, "v4"), (True, "v6")]:
+        with open(f"rc_mapping_{name}", "w") as rc_mapping:
+            for peer in sorted(peer for peer in peer_catalog
+                               if peer[4] == version):
+                rc_mapping.write('|'.join(
+                    map(str, [*peer[:4], *peer_catalog[peer]])) + '\n')
+
+
+def split_chunk(df_chunk,
+                writer_pool,
+                duplicate_absolutes,
+                peer_catalog,
+                producer=0):
+    # filter out only bgp udpates (no state messages)
+    df_chunk = df_chunk[df_chunk["message-type"] == 'U']
+
+    # figure out ip version
+    df_chunk["version"] = df_chunk["prefix"].str.contains(':')
+
+    if deduplicate:
+        # count updates per VP before and after dropping duplicates
+        update_counts = df_chunk.groupby(["peer-ip", "rc-name",
+                                          "version"]).size()
+        df_chunk = drop_duplicates(df_chunk)
+        update_counts = pd.concat(
+            [
+                update_counts,
+                df_chunk.groupby(["peer-ip", "rc-name", "version"]).size()
             ],
-            dtype=str,
-            chunksize=chunksize):
+            axis=1).fillna(0).astype(int)
+        for group_id, counts in update_counts.iterrows():
+            original_size, without_dupes_size = duplicate_absolutes.get(
+                get_filename(*group_id), (0, 0))
+            duplicate_absolutes[get_filename(*group_id)] = (
+                original_size + int(counts.iloc[0]),
+                without_dupes_size + int(counts.iloc[1]))
 
-        # filter out only bgp udpates (no state messages)
-        df_chunk = df_chunk[df_chunk["message-type"] == 'U']
+    sizes = print_to_files(writer_pool, df_chunk, producer)
+    update_catalog(peer_catalog, df_chunk, sizes)
 
-        # figure out ip version
-        df_chunk["version"] = df_chunk["prefix"].str.contains(':')
 
-        # group by peer, route collector, and IP version
-        df_chunk_groups = df_chunk.groupby(["peer-ip", "rc-name", "version"])
+def partition_blocks(blocks, num_readers):
+    """ assigns the blocks of the input file to readers. In a dump in
+    collector order, all blocks of a route collector go to the same reader,
+    so that the updates of a VP are written (and deduplicated) in order. A
+    time ordered dump (blocks of mixed collectors, *) is cut into contiguous
+    ranges of about equal size instead, see concatenate_ranges. """
+    if any(block[3] == "*" for block in blocks):
+        if deduplicate:
+            # the duplicates of a VP can only be found in a single pass
+            # over its updates
+            bap.log("deduplicating a time ordered dump, splitting it "
+                    "serially (use merge_order = \"collector\" in "
+                    "download_data.py to split it in parallel)")
+            return [blocks]
+        size = sum(block[1] for block in blocks)
+        partitions = [[] for _ in range(num_readers)]
+        position = 0
+        for block in blocks:
+            partitions[min(position * num_readers // max(size, 1),
+                           num_readers - 1)].append(block)
+            position += block[1]
+        return [partition for partition in partitions if partition]
 
-        bap.paral(print_to_file, [df_chunk_groups])
-        # for group_id, df_group in df_chunk_groups:
+    rc_blocks = defaultdict(list)
+    for block in blocks:
+        rc_blocks[block[2:]].append(block)
 
-        lines_processed += chunksize
+    # largest route collector first to the reader with the least bytes
+    partitions = [[] for _ in range(num_readers)]
+    partition_sizes = [0] * num_readers
+    for rc in sorted(rc_blocks,
+                     key=lambda rc: -sum(block[1] for block in rc_blocks[rc])):
+        reader = partition_sizes.index(min(partition_sizes))
+        partitions[reader] += rc_blocks[rc]
+        partition_sizes[reader] += sum(block[1] for block in rc_blocks[rc])
+    return [sorted(partition) for partition in partitions if partition]
+
+
+def concatenate_range_files(name, range_dirs):
+    """ appends the VP file name of each range to the VP file, in range
+    order """
+    filename = f"{split_dir}/{name}"
+    for range_dir in range_dirs:
+        range_filename = f"{range_dir}/{name}"
+        if not os.path.exists(range_filename):
+            continue
+        if name.endswith(".cols"):
+            output = bap.DumpColumnsWriter(filename)
+            for part in range(bap.count_dump_parts(range_filename)):
+                output.write(
+                    bap.read_dump_columns(range_filename, parts=[part]))
+        else:
+            # gzip members can be concatenated
+            with open(filename, "ab") as output, open(range_filename,
+                                                      "rb") as range_file:
+                shutil.copyfileobj(range_file, output)
+
+
+def concatenate_ranges(range_dirs):
+    """ the readers of a time ordered dump write the VP files of their
+    range into their own directory, as the ranges follow each other in time
+    the VP files are their concatenation """
+    names = sorted(set(itertools.chain(*map(os.listdir, range_dirs))))
+    with multiprocessing.Pool(num_writers) as pool:
+        pool.starmap(concatenate_range_files,
+                     [(name, range_dirs) for name in names])
+    for range_dir in range_dirs:
+        shutil.rmtree(range_dir)
+
+
+def split_blocks(blocks, writer_pool, results, producer, range_dir=None):
+    """ reader process: decompresses, parses and splits the given blocks of
+    the input file. With range_dir, the VP files are written there. """
+    if range_dir is not None:
+        # get_filename of this process
+        global split_dir
+        split_dir = range_dir
+    duplicate_absolutes = dict()
+    peer_catalog = dict()
+    lines_processed = 0
+
+    def split_batch(batch):
+        nonlocal lines_processed
+        if not batch:
+            return
+        df_chunk = pd.read_csv(io.BytesIO(b"".join(batch)),
+                               **read_csv_arguments)
+        split_chunk(df_chunk, writer_pool, duplicate_absolutes, peer_catalog,
+                    producer)
+        lines_processed += df_chunk.shape[0]
         bap.log(f"lines processed: {lines_processed}")
 
+    with open(input_file, "rb") as dump:
+        batch = []
+        batch_size = 0
+        for offset, length, _, _ in blocks:
+            dump.seek(offset)
+            data = gzip.decompress(dump.read(length))
+            if data and not data.endswith(b"\n"):
+                data += b"\n"
+            if data:
+                batch.append(data)
+                batch_size += len(data)
+            if batch_size >= reader_batch_size:
+                split_batch(batch)
+                batch = []
+                batch_size = 0
+        split_batch(batch)
+    writer_pool.flush(producer)
+    results.put((duplicate_absolutes, peer_catalog))
+
+
+def main():
+    global duplicate_absolutes
+    duplicate_absolutes = dict()
+    peer_catalog = dict()
+
+    blocks = bap.read_block_index(input_file)
+    # directories of the readers of a time ordered dump
+    range_dirs = []
+    if blocks is not None and num_readers > 1:
+        # parse the blocks in parallel
+        partitions = partition_blocks(blocks, num_readers)
+        if len(partitions) > 1 and blocks[0][3] == "*":
+            range_dirs = [
+                f"{split_dir}/.range-{producer}"
+                for producer in range(len(partitions))
+            ]
+            for range_dir in range_dirs:
+                bap.prep_dir(range_dir)
+        writer_pool = ShardWriterPool(num_writers, len(partitions))
+        results = multiprocessing.Queue()
+        readers = [
+            multiprocessing.Process(target=split_blocks,
+                                    args=(partition, writer_pool, results,
+                                          producer, range_dirs[producer]
+                                          if range_dirs else None),
+                                    daemon=True)
+            for producer, partition in enumerate(partitions)
+        ]
+        for reader in readers:
+            reader.start()
+        for _ in readers:
+            while True:
+                try:
+                    reader_duplicates, reader_catalog = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    for number, reader in enumerate(readers):
+                        if reader.exitcode not in (None, 0):
+                            raise RuntimeError(
+                                f"reader {number} failed with exit code "
+                                f"{reader.exitcode}")
+            # a VP is deduplicated by a single reader
+            duplicate_absolutes.update(reader_duplicates)
+            for peer, (updates, size) in reader_catalog.items():
+                previous_updates, previous_size = peer_catalog.get(
+                    peer, (0, 0))
+                peer_catalog[peer] = (previous_updates + updates,
+                                      previous_size + size)
+        for reader in readers:
+            reader.join()
+    else:
+        writer_pool = ShardWriterPool(num_writers)
+        # for the 2020 dataset the below chunksize was fastest
+        # chunksize = 5 * 10**7
+        chunksize = 10**7
+        lines_processed = 0
+        for df_chunk in pd.read_csv(input_file,
+                                    **read_csv_arguments,
+                                    chunksize=chunksize):
+            split_chunk(df_chunk, writer_pool, duplicate_absolutes,
+                        peer_catalog)
+
+            lines_processed += chunksize
+            bap.log(f"lines processed: {lines_processed}")
+    writer_pool.close()
+    if range_dirs:
+        concatenate_ranges(range_dirs)
+    write_rc_mapping(peer_catalog)
+
+    if deduplicate:
+        # saves portion of duplicates, like filter_duplicates.py
+        pd.Series(duplicate_absolutes).to_csv("duplicate_absolutes.csv",
+                                              sep='|',
+                                              header=None)
+
 
 main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the scripts and bgpana.py live in the repository root
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
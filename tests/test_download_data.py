@@ -0,0 +1,100 @@
+import concurrent.futures
+import gzip
+import os
+
+import download_data
+from conftest import repository
+
+fixtures = os.path.join(repository, "tests", "fixtures")
+
+# the records of tests/fixtures/ris/rrc00/2020.06/updates.20200601.0000.gz
+# within the time window, the last withdrawal of the file is after it
+expected_records = [
+    "U|W|1590969700|ris|rrc00|||65000|1.2.3.4|10.1.0.0/16||||||||||",
+    "U|A|1590969700|ris|rrc00|||65000|1.2.3.4|10.0.0.0/24|9.9.9.9|65000 70000 3|3|1:2 3:4||||||5",
+    "U|A|1590969700|ris|rrc00|||65000|1.2.3.4|192.168.0.0/23|9.9.9.9|65000 70000 3|3|1:2 3:4||||||5",
+    "U|W|1590969760|ris|rrc00|||65000|1.2.3.4|10.0.0.0/24||||||||||",
+]
+
+
+def test_download_dumps(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(download_data, "start_ts", "1590969600", raising=False)
+    monkeypatch.setattr(download_data, "end_ts", "1590969900", raising=False)
+    monkeypatch.setattr(download_data, "prefixes", [], raising=False)
+    monkeypatch.setattr(download_data, "url_suffixes",
+                        [("2020_06", "20200601.0000.bz2")])
+    monkeypatch.setattr(download_data, "decoder", "python")
+    monkeypatch.setattr(download_data, "cache_dir", None)
+    monkeypatch.setattr(download_data, "retry_backoff", 0)
+
+    # rrc00 fails twice before it is served, rrc01 does not exist
+    failures = {"/ris/rrc00/2020.06/updates.20200601.0000.gz": 2}
+    with download_data.fixture_server(fixtures, failures) as base_url,\
+            concurrent.futures.ProcessPoolExecutor(1) as decoder_pool:
+        monkeypatch.setitem(download_data.url_bases, "ris", base_url + "/ris")
+        monkeypatch.setattr(download_data,
+                            "decoder_pool",
+                            decoder_pool,
+                            raising=False)
+        segments, complete = download_data._download_dumps(
+            "ris", ["rrc00", "rrc01"])
+
+    assert complete
+    assert [segment[:2] for segment in segments] == [("ris", "rrc00"),
+                                                     ("ris", "rrc01")]
+    with gzip.open(segments[0][2], "rt") as records:
+        assert records.read().splitlines() == expected_records
+    assert os.path.getsize(segments[1][2]) == 0
+
+    manifest = open(".temp_download_ris.dump/manifest.csv").read().splitlines()
+    statuses = dict(line.split("|")[:2] for line in manifest[1:])
+    assert statuses == {
+        os.path.basename(segments[0][2]): "done",
+        os.path.basename(segments[1][2]): "missing"
+    }
+
+
+def write_records(filename, timestamps, rc, file_number):
+    """ writes decoded records with a prefix per file and position """
+    with gzip.open(filename, "wb") as records:
+        for number, ts in enumerate(timestamps):
+            records.write(
+                f"U|A|{ts}|ris|{rc}|||65000|1.2.3.4|"
+                f"10.{file_number}.{number}.0/24|1.2.3.4|65000 3|3|||||||\n".
+                encode())
+
+
+def test_write_dump_sorts_collectors(tmp_path, monkeypatch):
+    monkeypatch.setattr(download_data, "merge_order", "time")
+    monkeypatch.setattr(download_data, "write_block_index", False)
+    # files of consecutive intervals with records that are out of order
+    # within a file and across files, and a timestamp that repeats
+    files = {
+        "rrc00": [[1590969700, 1590969650, 1590969900, 1590969600],
+                  [1590969800, 1590970200, 1590969900, 1590970100]],
+        "rrc01": [[1590969620, 1590969900, 1590969610],
+                  [1590970000, 1590969950]]
+    }
+    segments = []
+    for rc, timestamps in files.items():
+        for number, file_timestamps in enumerate(timestamps):
+            filename = str(tmp_path / f"{rc}_{number}.gz")
+            write_records(filename, file_timestamps, rc, number)
+            segments.append(("ris", rc, filename))
+
+    output_filename = str(tmp_path / "updates.dump.gz")
+    download_data.write_dump(segments, output_filename)
+    with gzip.open(output_filename, "rt") as dump:
+        lines = dump.read().splitlines()
+
+    timestamps = [int(line.split("|")[2]) for line in lines]
+    assert timestamps == sorted(
+        ts for rc_timestamps in files.values()
+        for file_timestamps in rc_timestamps for ts in file_timestamps)
+    # records of equal timestamp keep the order of their collector's files
+    assert [(line.split("|")[4], line.split("|")[9]) for line in lines
+            if line.split("|")[2] == "1590969900"] == [
+                ("rrc00", "10.0.2.0/24"), ("rrc00", "10.1.2.0/24"),
+                ("rrc01", "10.0.1.0/24")
+            ]
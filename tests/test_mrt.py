@@ -0,0 +1,116 @@
+import ipaddress
+import struct
+
+import mrt
+
+
+def attribute(attribute_type, value, flags=0x40):
+    return struct.pack(">BBB", flags, attribute_type, len(value)) + value
+
+
+def nlri(prefixes, path_id=None):
+    data = b""
+    for prefix in prefixes:
+        network = ipaddress.ip_network(prefix)
+        if path_id is not None:
+            data += struct.pack(">I", path_id)
+        data += bytes([network.prefixlen]) + network.network_address.packed[:(
+            network.prefixlen + 7) // 8]
+    return data
+
+
+def as_path(segments, as_size):
+    asn_format = ">%dI" if as_size == 4 else ">%dH"
+    return b"".join(
+        bytes([segment_type, len(asns)]) +
+        struct.pack(asn_format % len(asns), *asns)
+        for segment_type, asns in segments)
+
+
+def update(withdrawn=b"", attributes=b"", announced=b""):
+    body = struct.pack(">H", len(withdrawn)) + withdrawn + struct.pack(
+        ">H", len(attributes)) + attributes + announced
+    return b"\xff" * 16 + struct.pack(">HB", 19 + len(body),
+                                      mrt.BGP_UPDATE) + body
+
+
+def record(ts, subtype, message, peer_asn=65000, peer_ip="1.2.3.4"):
+    as_size = 4 if subtype in mrt.as4_subtypes else 2
+    address = ipaddress.ip_address(peer_ip)
+    afi = mrt.AFI_IPV4 if address.version == 4 else mrt.AFI_IPV6
+    body = peer_asn.to_bytes(as_size, "big") + (1).to_bytes(
+        as_size, "big") + struct.pack(">HH", 0, afi) + address.packed * 2
+    body += message
+    return struct.pack(">IHHI", ts, mrt.BGP4MP, subtype, len(body)) + body
+
+
+origin = attribute(mrt.ORIGIN, b"\x00")
+next_hop = attribute(mrt.NEXT_HOP, ipaddress.ip_address("9.9.9.9").packed)
+med = attribute(mrt.MULTI_EXIT_DISC, struct.pack(">I", 5), 0x80)
+communities = attribute(mrt.COMMUNITIES, struct.pack(">HHHH", 1, 2, 3, 4),
+                        0xC0)
+
+records = [
+    # 2 byte AS session: AS_TRANS (23456) in AS_PATH and AGGREGATOR is
+    # replaced by AS4_PATH and AS4_AGGREGATOR
+    record(
+        1590969700, mrt.MESSAGE,
+        update(attributes=origin + attribute(
+            mrt.AS_PATH, as_path([(2, [65000, 23456]), (1, [3, 4])], 2)) +
+               next_hop + attribute(mrt.ATOMIC_AGGREGATE, b"") +
+               attribute(mrt.AGGREGATOR,
+                         struct.pack(">H", 23456) + bytes([8, 8, 8, 8]), 0xC0)
+               + attribute(mrt.AS4_PATH,
+                           as_path([(2, [70000]), (1, [3, 4])], 4), 0xC0) +
+               attribute(mrt.AS4_AGGREGATOR,
+                         struct.pack(">I", 70000) + bytes([8, 8, 8, 8]), 0xC0),
+               announced=nlri(["10.0.0.0/24"]))),
+    # IPv6 session with MP_REACH_NLRI and MP_UNREACH_NLRI
+    record(1590969701,
+           mrt.MESSAGE_AS4,
+           update(attributes=origin +
+                  attribute(mrt.AS_PATH, as_path([(2, [65000, 3])], 4)) +
+                  attribute(
+                      mrt.MP_REACH_NLRI,
+                      struct.pack(">HBB", mrt.AFI_IPV6, 1, 16) +
+                      ipaddress.ip_address("2001:db8::9").packed + b"\x00" +
+                      nlri(["2001:db8:1::/48", "2001:db8:2::/47"]), 0x80) +
+                  attribute(
+                      mrt.MP_UNREACH_NLRI,
+                      struct.pack(">HB", mrt.AFI_IPV6, 1) +
+                      nlri(["2001:db8:3::/48"]), 0x80) + med + communities),
+           peer_ip="2001:db8::1"),
+    # add-path: every prefix is preceded by a path identifier
+    record(
+        1590969702, mrt.MESSAGE_AS4_ADDPATH,
+        update(withdrawn=nlri(["10.1.0.0/16"], path_id=7),
+               attributes=origin + attribute(
+                   mrt.AS_PATH, as_path([(2, [65000, 70000, 3])], 4)) +
+               next_hop,
+               announced=nlri(["10.2.0.0/16", "0.0.0.0/0"], path_id=8))),
+]
+
+expected_records = [
+    "U|A|1590969700|ris|rrc00|||65000|1.2.3.4|10.0.0.0/24|9.9.9.9|65000 70000 {3,4}|{3,4}||||AG|8.8.8.8|70000|",
+    "U|W|1590969701|ris|rrc00|||65000|2001:db8::1|2001:db8:3::/48||||||||||",
+    "U|A|1590969701|ris|rrc00|||65000|2001:db8::1|2001:db8:1::/48|2001:db8::9|65000 3|3|1:2 3:4||||||5",
+    "U|A|1590969701|ris|rrc00|||65000|2001:db8::1|2001:db8:2::/47|2001:db8::9|65000 3|3|1:2 3:4||||||5",
+    "U|W|1590969702|ris|rrc00|||65000|1.2.3.4|10.1.0.0/16||||||||||",
+    "U|A|1590969702|ris|rrc00|||65000|1.2.3.4|10.2.0.0/16|9.9.9.9|65000 70000 3|3|||||||",
+    "U|A|1590969702|ris|rrc00|||65000|1.2.3.4|0.0.0.0/0|9.9.9.9|65000 70000 3|3|||||||",
+]
+
+
+def test_decode_records():
+    decoded = [
+        "|".join(fields)
+        for fields in mrt.decode_records(b"".join(records), "ris", "rrc00")
+    ]
+    assert decoded == expected_records
+    assert all(len(line.split("|")) == 20 for line in decoded)
+
+
+def test_decode_records_filters():
+    decoded = mrt.decode_records(b"".join(records), "ris", "rrc00",
+                                 (1590969701, 1590969701), ["2001:db8::/32"])
+    assert ["|".join(fields) for fields in decoded] == expected_records[1:4]
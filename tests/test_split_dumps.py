@@ -0,0 +1,118 @@
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+
+import bgpana as bap
+from conftest import repository
+
+fixtures = os.path.join(repository, "tests", "fixtures")
+
+# columns of the *_no_dupes files, see filter_duplicates.py
+no_dupes_columns = [
+    "message-type", "upd-type", "rc-project", "rc-name", "peer-AS", "peer-ip",
+    "next-hop", "path", "origin-AS", "communities", "atomic-agg", "agg-ip",
+    "agg-AS", "med", "isv6", "prefix", "ts"
+]
+
+
+def run_split(directory, flags, input_files=None):
+    """ runs split_dumps_fast.py with flags (name -> value as code) on the
+    first of input_files (default: the fixture updates), returns the split
+    directory and the log """
+    os.makedirs(directory)
+    script = open(os.path.join(repository, "split_dumps_fast.py")).read()
+    for flag, value in {"num_writers": "2", **flags}.items():
+        lines = [
+            line for line in script.splitlines()
+            if line.startswith(f"{flag} = ")
+        ]
+        assert len(lines) == 1
+        script = script.replace(lines[0], f"{flag} = {value}")
+    open(os.path.join(directory, "split_dumps_fast.py"), "w").write(script)
+    shutil.copy(os.path.join(repository, "bgpana.py"), directory)
+    if input_files is None:
+        input_files = [os.path.join(fixtures, "updates.txt")]
+    for input_file in input_files:
+        shutil.copy(input_file, directory)
+    open(os.path.join(directory, "config_week.ini"), "w").write(
+        "[general]\ninput-file = "
+        f"{os.path.basename(input_files[0])}\n")
+    log = subprocess.run([sys.executable, "split_dumps_fast.py"],
+                         cwd=directory,
+                         check=True,
+                         capture_output=True,
+                         text=True).stdout
+    return os.path.join(directory, "split_dump_raw"), log
+
+
+def read_split(split_dir):
+    """ the lines of each VP file in split_dir """
+    files = dict()
+    for filename in sorted(os.listdir(split_dir)):
+        path = os.path.join(split_dir, filename)
+        if filename.endswith(".cols"):
+            files[filename] = bap.read_dump_columns(path).astype(
+                str).values.tolist()
+        else:
+            with gzip.open(path, "rt") as dump:
+                files[filename] = dump.read().splitlines()
+    return files
+
+
+def test_deduplicated_columns(tmp_path):
+    gzip_dir, _ = run_split(tmp_path / "gzip", {
+        "deduplicate": "True",
+        "output_format": '"gzip"'
+    })
+    columns_dir, _ = run_split(tmp_path / "columns", {
+        "deduplicate": "True",
+        "output_format": '"columns"'
+    })
+
+    filenames = sorted(os.listdir(gzip_dir))
+    assert filenames and all("_dumps_no_dupes.gz" in f for f in filenames)
+    for filename in filenames:
+        path = os.path.join(columns_dir, filename.replace(".gz", ".cols"))
+        df = bap.read_dump_columns(path)
+        assert df.columns.tolist() == no_dupes_columns
+        lines = [
+            "|".join([str(value) for value in row[:-1]] + [repr(row[-1])])
+            for row in df.itertuples(index=False)
+        ]
+        with gzip.open(os.path.join(gzip_dir, filename), "rt") as dump:
+            assert lines == dump.read().splitlines()
+
+
+def test_time_ordered_ranges(tmp_path):
+    # a time ordered dump with a block index, like download_data.py writes
+    # it with merge_order = "time"
+    lines = open(os.path.join(fixtures, "updates.txt"),
+                 "rb").read().splitlines(keepends=True)
+    lines.sort(key=lambda line: float(line.split(b"|")[2]))
+    dump_filename = str(tmp_path / "updates.dump.gz")
+    blocks = []
+    with open(dump_filename, "wb") as dump:
+        for start in range(0, len(lines), 15):
+            data = gzip.compress(b"".join(lines[start:start + 15]), mtime=0)
+            blocks.append((dump.tell(), len(data), "*", "*"))
+            dump.write(data)
+    bap.write_block_index(dump_filename, blocks)
+
+    for output_format in ["gzip", "columns"]:
+        flags = {"output_format": f'"{output_format}"', "num_readers": "3"}
+        serial_dir, _ = run_split(tmp_path / f"serial_{output_format}",
+                               {**flags, "num_readers": "1"},
+                               [dump_filename])
+        ranges_dir, log = run_split(
+            tmp_path / f"ranges_{output_format}", flags,
+            [dump_filename, dump_filename + ".index"])
+        assert "serially" not in log
+        assert not os.path.exists(os.path.join(ranges_dir, ".range-0"))
+        assert read_split(ranges_dir) == read_split(serial_dir)
+        assert len(read_split(serial_dir)) > 1
+        assert open(os.path.join(os.path.dirname(ranges_dir),
+                                 "rc_mapping_v4")).read() == open(
+                                     os.path.join(os.path.dirname(serial_dir),
+                                                  "rc_mapping_v4")).read()
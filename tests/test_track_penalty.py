@@ -0,0 +1,57 @@
+import pickle
+
+import numpy as np
+
+import bgpana as bap
+
+
+def checkpoint_in_worker(directory, version, prefixes):
+    """ fills a state table and a state store in a bap.paral worker and
+    pickles them like track_penalty.write_checkpoint """
+    table = bap.PrefixStateTable(version, capacity=2)
+    for ts, prefix in enumerate(prefixes):
+        slot = table.slot(prefix, ts)
+        table.penalty[slot] += 1000
+        table.set_last_update_type(slot, "W")
+    store = bap.StateStore(f"{directory}/{version}_saved_states",
+                           block_length=2)
+    store.write("".join(f"{ts}|1.2.3.4|{prefix}|1000.0\n"
+                        for ts, prefix in enumerate(prefixes)).encode())
+    store.close()
+    filename = f"{directory}/{version}.checkpoint"
+    with open(filename, "wb") as checkpoint_file:
+        pickle.dump({"table": table, "output_size": store.rows},
+                    checkpoint_file)
+    return filename
+
+
+def test_checkpoint_in_worker(tmp_path):
+    prefixes = {
+        "v4": ["10.0.0.0/24", "10.0.1.0/24", "10.0.0.0/24", "0.0.0.0/0"],
+        "v6": ["2001:db8::/32", "::/0", "2001:db8::/48"]
+    }
+    filenames = bap.paral(checkpoint_in_worker,
+                          [[str(tmp_path)] * 2, ["v4", "v6"],
+                           [prefixes["v4"], prefixes["v6"]]],
+                          num_cores=2,
+                          progress_bar=False)
+    for version, filename in zip(["v4", "v6"], filenames):
+        with open(filename, "rb") as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+        table = checkpoint["table"]
+        assert sorted(p for p in table.prefixes if p is not None) == sorted(
+            set(prefixes[version]))
+        for prefix in set(prefixes[version]):
+            slot = table.slot(prefix, 0)
+            assert table.penalty[slot] == 1000 * prefixes[version].count(
+                prefix)
+            assert table.get_last_update_type(slot) == "W"
+        assert checkpoint["output_size"] == len(prefixes[version])
+
+        store = bap.StateStore(f"{tmp_path}/{version}_saved_states",
+                               append=True,
+                               block_length=2)
+        assert store.rows == len(prefixes[version])
+        snapshots = bap.read_state_store(f"{tmp_path}/{version}_saved_states")
+        assert np.array_equal(snapshots["penalty"].to_numpy(),
+                              np.full(len(prefixes[version]), 1000.0))
@@ -8,6 +8,14 @@ from tqdm import tqdm
 import bgpana as bap
 from collections import defaultdict
 import gzip
+import pickle
+import time
+import argparse
+import queue
+import socket
+import sys
+import threading
+import shutil
 
 # ------------------------------------------------------------
 # TEST MODE
@@ -29,174 +37,984 @@ if not test:
 
 do_done_check = False
 
+# "python" replays every update line by line, "numpy" replays whole prefix
+# groups with batched array operations (see replay_numpy)
+engine = "python"
 
-def main(vendor, version):
-    def process_vp(peer):
-        # store last update type
-        # init with empty string
-        last_update_type = dict()
+# "snapshots" saves the penalty of every prefix each save_interval seconds,
+# "events" saves a prefix's penalty only when an update changes it; the
+# penalty at any later time follows in closed form (see bap.penalty_at)
+output_mode = "snapshots"
 
-        # fill penalties dict
-        # defaultdict with penalty inititally 0
-        # prefix -> (penalty, last updated)
-        penalties = dict()
+# in snapshot mode, write the snapshots into a partitioned store (hourly
+# blocks of binary columns with an index on save_time and a prefix
+# dictionary, see bap.StateStore and bap.read_state_store) instead of a flat
+# *_saved_states.gz file
+snapshot_store = False
 
-        # set first second of the measurement
-        last_ts = (int(config["general"]["start-ts"]) if not test else 0) - 1
+# columns of a *_dumps_no_dupes.gz file, in file order
+dump_columns = [
+    "message-type", "upd-type", "rc-project", "rc-name", "peer-AS", "peer-ip",
+    "next-hop", "path", "origin-AS", "communities", "atomic-agg", "agg-ip",
+    "agg-AS", "med", "isv6", "prefix", "ts"
+]
 
-        # open states file
-        filename = f"{states_dir}/{peer['ip']}_{peer['rc']}_{version}_saved_states.gz"
+# the per-line loop pickles its full state every checkpoint_interval seconds
+# (wall-clock) and resumes from the last checkpoint after a crash
+checkpoint_dir = "checkpoints"
+checkpoint_interval = 10 * 60
+resume = True
 
-        #if states file already exists, then quit
-        if do_done_check and os.path.exists(filename):
-            return
+# stream mode: input lines buffered between the reader and the simulation,
+# and seconds without input after which the output is flushed
+stream_queue_size = 100000
+stream_flush_interval = 5
+
+# seconds between evictions of fully decayed prefixes in event mode, in
+# snapshot mode they are evicted at every save
+eviction_interval = 60 * 60
+
+# number of seconds of save times expanded at once by the numpy engine
+numpy_window = 6 * 60 * 60
+
+# VPs are processed largest first by the size of their updates (bytes column
+# of rc_mapping, see split_dumps_fast.py). With a memory_budget in bytes, a
+# VP is estimated to need memory_per_byte times that size and VPs only start
+# while their estimates fit into the budget
+memory_budget = None
+memory_per_byte = 4
+
+
+def get_dump_filename(peer, version):
+    """ no-dupes dump file of a VP, either pipe-separated or in the columnar
+    format of bap.DumpColumnsWriter """
+    filename = f"{split_dir}/{peer['ip']}_{peer['rc']}_{version}_dumps_no_dupes.gz"
+    if not os.path.exists(filename) and os.path.exists(
+            filename.replace(".gz", ".cols")):
+        return filename.replace(".gz", ".cols")
+    return filename
+
+
+def read_dump_updates(filename, offset):
+    """ yields (offset, upd_type, prefix, ts, line) for the updates of a
+    no-dupes dump, starting at offset. The offset is the uncompressed byte
+    position in a pipe-separated dump and the row in a columnar dump. """
+    if filename.endswith(".cols"):
+        df = bap.read_dump_columns(filename, ["upd-type", "prefix", "ts"])
+        for row, (upd_type, prefix, ts) in enumerate(zip(
+                df["upd-type"].tolist()[offset:],
+                df["prefix"].tolist()[offset:], df["ts"].tolist()[offset:]),
+                                                     start=offset + 1):
+            yield row, upd_type, prefix, ts, f"{upd_type}|{prefix}|{ts}\n"
+        return
+
+    # skipping to the offset still decompresses, but nothing is parsed
+    dump = gzip.open(filename, "rb")
+    dump.seek(offset)
+
+    for line in dump:
+        offset += len(line)
+
+        # parse update line
+        try:
+            message_type, upd_type, rc_project, rc_name, peer_AS, peer_ip,\
+                    next_hop, path, origin_AS, communities, atomic_agg,\
+                    agg_ip, agg_AS, med, isv6, prefix, ts \
+                    = line.decode().split('|')
+        except:
+            bap.log(f"parsing error\n{line.decode()}\n{filename=}")
+
+        yield offset, upd_type, prefix, float(ts.rstrip()), line.decode()
+
+
+def load_vp_columns(filename):
+    """ loads the (ts, prefix, upd-type) columns of a no-dupes dump file """
+    if filename.endswith(".cols"):
+        df = bap.read_dump_columns(filename, ["upd-type", "prefix", "ts"])
+        ts = df["ts"].to_numpy().astype(np.int64)
+        prefix_codes, prefix_names = pd.factorize(df["prefix"])
+        upd_types = df["upd-type"].to_numpy().astype("U1")
+        return ts, prefix_codes, np.asarray(prefix_names), upd_types
+
+    try:
+        df = pd.read_csv(filename,
+                         sep='|',
+                         header=None,
+                         names=dump_columns,
+                         usecols=["upd-type", "prefix", "ts"],
+                         dtype={
+                             "upd-type": str,
+                             "prefix": str,
+                             "ts": np.float64
+                         })
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame({"upd-type": [], "prefix": [], "ts": []})
+
+    # we process updates at second granularity
+    ts = df["ts"].to_numpy().astype(np.int64)
+
+    # codes are assigned in order of first appearance, i.e. the same order
+    # in which the per-line loop inserts prefixes into its penalties dict
+    prefix_codes, prefix_names = pd.factorize(df["prefix"])
+    upd_types = df["upd-type"].fillna("").to_numpy().astype("U1")
+    return ts, prefix_codes, np.asarray(prefix_names), upd_types
+
+
+def replay_numpy(ts, prefix_codes, upd_types, params):
+    """ computes the penalty of every update's prefix right after the update
+
+    Updates are grouped by prefix (stable, so the file order is kept inside a
+    group). Between two resets the penalty is a decayed sum of increments,
+    which is a segmented cumulative sum once every increment is scaled by
+    2^((t - t_segment_start) / half_life). The Cisco reset below reuse/2 ends
+    a segment. Resets are found by fixpoint iteration: computing a segment
+    without a reset that happens inside it can only overestimate the
+    penalties, so every reset detected from the overestimate is a real one.
+    To keep the scale factors finite, segments are additionally cut every
+    rebase_half_lives half-lives and carry the decayed penalty over.
+    The penalty ceiling turns the cumulative sum into a clamped one: the
+    scaled penalty is S_i + min(0, min_{j <= i}(ceiling_j - S_j)), where S is
+    the unclamped cumulative sum, i.e. a segmented cumulative minimum.
+
+    Returns the grouping order, the grouped arrays, the penalty increment,
+    the decayed penalty before and the penalty after each (grouped)
+    update. """
+    rebase_half_lives = 500
+    half_life = params["half_life"]
+    reuse_threshold = params["reuse_threshold"]
+    maximum_penalty = params["maximum_penalty"]
+    if maximum_penalty is None:
+        maximum_penalty = np.inf
+
+    order = np.argsort(prefix_codes, kind="stable")
+    g_codes = prefix_codes[order]
+    g_ts = ts[order]
+    g_types = upd_types[order]
+    n = len(order)
+
+    first = np.ones(n, dtype=bool)
+    first[1:] = g_codes[1:] != g_codes[:-1]
+
+    # type of the previous update of the same prefix, "" for the first
+    prev_types = np.empty(n, dtype="U1")
+    prev_types[1:] = g_types[:-1]
+    prev_types[first] = ""
+
+    # penalty increments, identical to the branches of the per-line loop
+    increments = np.zeros(n)
+    increments[g_types == 'W'] = params["withdrawal_penalty"]
+    increments[(g_types == 'A')
+               & (prev_types != 'W')] = params["attribute_change_penalty"]
+    increments[(g_types == 'A')
+               & (prev_types == 'W')] = params["readvertisement_penalty"]
+
+    # time since the previous update of the same prefix
+    deltas = np.zeros(n, dtype=np.int64)
+    deltas[1:] = g_ts[1:] - g_ts[:-1]
+    deltas[first] = 0
+    decays = 0.5**(deltas / half_life)
+
+    # segments that carry the penalty of their predecessor
+    prefix_start_ts = g_ts[first][np.cumsum(first) - 1]
+    buckets = (g_ts - prefix_start_ts) // int(rebase_half_lives * half_life)
+    rebases = np.zeros(n, dtype=bool)
+    rebases[1:] = buckets[1:] != buckets[:-1]
+    rebases &= ~first
+
+    resets = first.copy()
+    while True:
+        boundaries = resets | rebases
+        segment_ids = np.cumsum(boundaries) - 1
+        segment_start_ts = g_ts[boundaries][segment_ids]
+        scale = 2**((g_ts - segment_start_ts) / half_life)
+        scaled = increments * scale
+        cumulative = pd.Series(scaled).groupby(segment_ids).cumsum().to_numpy()
+        ceilings = maximum_penalty * scale
+
+        # resolve the carried penalties, one chained segment per iteration
+        carries = np.zeros(n)
+        carried = rebases & ~resets
+        while True:
+            sums = cumulative + carries[boundaries][segment_ids]
+            clamps = pd.Series(ceilings - sums).groupby(
+                segment_ids).cummin().to_numpy()
+            penalties = (sums + np.minimum(clamps, 0)) / scale
+            new_carries = np.zeros(n)
+            new_carries[1:] = penalties[:-1] * decays[1:]
+            new_carries[~carried] = 0
+            if np.array_equal(new_carries, carries):
+                break
+            carries = new_carries
+
+        # penalty right before the increment of each update
+        decayed = np.zeros(n)
+        decayed[1:] = penalties[:-1] * decays[1:]
+        new_resets = ~resets & (deltas > 0) & (decayed < reuse_threshold / 2)
+        if not new_resets.any():
+            return order, g_codes, g_ts, increments, decayed, penalties
+        resets |= new_resets
+
+
+def replay_suppressions_numpy(g_codes, g_ts, decayed, penalties, params):
+    """ finds the suppression intervals of the updates replayed by
+    replay_numpy, equivalent to the tracking in the per-line loop.
+
+    A prefix is suppressed after update i if the update pushed the penalty
+    above the suppress threshold, or if it was suppressed before and the
+    penalty has not decayed below the reuse threshold until update i, i.e.
+    if the last suppressing update is not older than the last reuse. """
+    n = len(g_codes)
+    index = np.arange(n)
+    first = np.ones(n, dtype=bool)
+    first[1:] = g_codes[1:] != g_codes[:-1]
+
+    kept = ~first & (decayed >= params["reuse_threshold"])
+    last_start = np.maximum.accumulate(
+        np.where(penalties > params["suppress_threshold"], index, -1))
+    last_reuse = np.maximum.accumulate(np.where(~kept, index, -1))
+    suppressed = (last_start >= 0) & (last_start >= last_reuse)
+
+    previous = np.zeros(n, dtype=bool)
+    previous[1:] = suppressed[:-1]
+    run_starts = suppressed & ~(previous & kept)
+    run_ids = (np.cumsum(run_starts) - 1)[suppressed]
+    runs = pd.DataFrame({
+        "ts": g_ts[suppressed],
+        "prefix": g_codes[suppressed],
+        "penalty": penalties[suppressed]
+    }).groupby(run_ids)
+    last = runs.last()
+    return pd.DataFrame({
+        "start": runs["ts"].first(),
+        "end": reuse_time(last["penalty"], last["ts"], params),
+        "prefix": last["prefix"],
+        "max_penalty": runs["penalty"].max()
+    })
+
+
+def reuse_time(penalty, ts, params):
+    """ returns the second at which the penalty given at ts has decayed below
+    the reuse threshold """
+    return np.ceil(ts + params["half_life"] *
+                   np.log2(penalty / params["reuse_threshold"])).astype(np.int64)
+
+
+def close_suppression(suppression, params):
+    """ returns the interval (start, end, prefix, max_penalty) of an open
+    suppression of the per-line loop """
+    return (suppression["start"],
+            int(reuse_time(suppression["penalty"], suppression["updated"],
+                           params)), suppression["prefix"],
+            suppression["max_penalty"])
+
+
+def write_suppressions(filename, index_filename, peer, suppressions):
+    """ writes suppression intervals (start|end|ip|prefix|max_penalty) sorted
+    by start, and an index with the byte offsets of each prefix's rows """
+    suppressions = suppressions.sort_values(["start", "prefix"],
+                                            kind="stable")
+    suppressions.insert(2, "ip", peer['ip'])
+    rows = suppressions.to_csv(sep='|', header=False,
+                               index=False).encode().splitlines(keepends=True)
+    offsets = np.cumsum([0] + [len(row) for row in rows])[:-1]
+
+    with open(filename, "wb") as table:
+        table.write(b"".join(rows))
+
+    with open(index_filename, "w") as index:
+        for prefix, prefix_offsets in pd.Series(offsets).groupby(
+                suppressions["prefix"].to_numpy()):
+            index.write(f"{prefix}|{','.join(map(str, prefix_offsets))}\n")
+
+
+def process_vp_numpy(columns, saved_states, peer, first_save_ts, params):
+    """ numpy engine equivalent of the per-line loop in process_vp, returns
+    the suppression intervals """
+    ts, prefix_codes, prefix_names, upd_types = columns
+    if len(ts) == 0:
+        return pd.DataFrame(columns=["start", "end", "prefix", "max_penalty"])
+
+    half_life = params["half_life"]
+    reuse_threshold = params["reuse_threshold"]
+    order, g_codes, g_ts, increments, decayed, penalties = replay_numpy(
+        ts, prefix_codes, upd_types, params)
+
+    suppressions = replay_suppressions_numpy(g_codes, g_ts, decayed,
+                                             penalties, params)
+    suppressions["prefix"] = prefix_names[suppressions["prefix"].to_numpy()]
+
+    if output_mode == "events":
+        # one record per update that changed the penalty, in file order
+        changed = np.flatnonzero(increments != 0)
+        changed = changed[np.argsort(order[changed], kind="stable")]
+        saved_states.write(
+            pd.DataFrame({
+                "ts": g_ts[changed],
+                "ip": peer['ip'],
+                "prefix": prefix_names[g_codes[changed]],
+                "penalty": penalties[changed]
+            }).to_csv(sep='|', header=False, index=False).encode())
+        return suppressions
+
+    # a save at save_time sees all updates with ts < save_time, so update i
+    # determines the saved penalty of its prefix for all save times in
+    # (ts_i, ts of the next update of the prefix]; saving stops at the last
+    # timestamp of the file
+    last_ts = ts.max()
+    next_ts = np.empty_like(g_ts)
+    next_ts[:-1] = g_ts[1:]
+    last_of_prefix = np.ones(len(g_ts), dtype=bool)
+    last_of_prefix[:-1] = g_codes[:-1] != g_codes[1:]
+    next_ts[last_of_prefix] = last_ts
+
+    # penalties below half the reuse threshold are reset and not saved
+    with np.errstate(divide="ignore"):
+        decay_limit = g_ts + half_life * np.log2(
+            2 * penalties / reuse_threshold) + save_interval
+    decay_limit = np.maximum(decay_limit, g_ts)
+    first_save = np.maximum((g_ts // save_interval + 1) * save_interval,
+                            first_save_ts)
+    last_save = np.minimum(np.minimum(next_ts, last_ts),
+                           decay_limit).astype(np.int64)
+    last_save = last_save // save_interval * save_interval
+    valid = first_save <= last_save
+    first_save, last_save = first_save[valid], last_save[valid]
+    base_ts, base_penalties, codes = g_ts[valid], penalties[valid], g_codes[
+        valid]
+
+    # expand the save time ranges window by window so that the output stays
+    # sorted by save time without materializing all rows at once
+    # saved penalties are decayed save by save (first from the update to the
+    # first save time, then by one save interval at a time) exactly like the
+    # per-line loop does, so that values agree bit by bit given equal update
+    # penalties
+    step_decay = 0.5**(save_interval / half_life)
+    last_values = np.zeros(len(first_save))
+    by_start = np.argsort(first_save, kind="stable")
+    active = np.empty(0, dtype=np.int64)
+    position = 0
+    window_start = first_save.min() if len(first_save) else last_ts + 1
+    while window_start <= last_ts:
+        window_end = window_start + numpy_window
+        new_position = np.searchsorted(first_save[by_start], window_end)
+        active = np.concatenate([
+            active[last_save[active] >= window_start],
+            by_start[position:new_position]
+        ])
+        position = new_position
+
+        lows = np.maximum(first_save[active], window_start)
+        highs = np.minimum(last_save[active], window_end - 1)
+        counts = np.maximum((highs - lows) // save_interval + 1, 0)
+        rows = np.repeat(active, counts)
+        range_starts = np.cumsum(counts) - counts
+        offsets = np.arange(counts.sum()) - np.repeat(range_starts, counts)
+        save_times = np.repeat(lows, counts) + offsets * save_interval
+
+        start_values = np.where(
+            first_save[active] < window_start,
+            last_values[active] * step_decay,
+            base_penalties[active] * (0.5**(
+                (first_save[active] - base_ts[active]) / half_life)))
+        factors = np.full(len(rows), step_decay)
+        factors[range_starts[counts > 0]] = start_values[counts > 0]
+        new_penalties = pd.Series(factors).groupby(
+            rows, sort=False).cumprod().to_numpy()
+        last_values[active[counts > 0]] = new_penalties[range_starts[counts > 0]
+                                                        + counts[counts > 0] -
+                                                        1]
+
+        keep = new_penalties >= reuse_threshold / 2
+        rows, save_times, new_penalties = rows[keep], save_times[
+            keep], new_penalties[keep]
+        row_order = np.lexsort((codes[rows], save_times))
+        if isinstance(saved_states, bap.StateStore):
+            saved_states.write_arrays(save_times[row_order],
+                                      prefix_names[codes[rows[row_order]]],
+                                      new_penalties[row_order])
         else:
-            saved_states = gzip.open(filename, "wb+")
-
-        # get filename depending on IP version
-        filename = f"{split_dir}/{peer['ip']}_{peer['rc']}_{version}_dumps_no_dupes.gz"
-
-        # stop processing if file does not exist
-        if not os.path.exists(filename):
-            bap.log(f"file does not exist: {filename}")
-            return
-
-        for line in gzip.open(filename, "rb"):
-            # parse update line
-            try:
-                message_type, upd_type, rc_project, rc_name, peer_AS, peer_ip,\
-                        next_hop, path, origin_AS, communities, atomic_agg,\
-                        agg_ip, agg_AS, med, isv6, prefix, ts \
-                        = line.decode().split('|')
-            except:
-                bap.log(f"parsing error\n{line.decode()}\n{filename=}")
-
-            # parse the timestamp as int because we process updates at second
-            # granularity
-            ts = int(float(ts.rstrip()))
+            saved_states.write(
+                pd.DataFrame({
+                    "save_time": save_times[row_order],
+                    "ip": peer['ip'],
+                    "prefix": prefix_names[codes[rows[row_order]]],
+                    "penalty": new_penalties[row_order]
+                }).to_csv(sep='|', header=False, index=False).encode())
 
-            # if the lines are not sorted then there is an issue -> print
-            if ts < last_ts:
-                bap.log(
-                    f"file is not sorted:{filename=}\n{line.decode()}{ts=}{last_ts=}"
-                )
-
-            # if we have reached a new second then ...
-            if ts > last_ts:
-                # find all save-timestamps between the new timestamp and the last timestamp
-                # (not including the last timestamp, but including the new timestamp)
-                # because of the mechanism, the first timestamp is not saved
-                timestamp_to_save = [
-                    save_time for save_time in range(last_ts + 1, ts + 1)
-                    if save_time % save_interval == 0
-                ]
-                # save all states thare are to save if there are any
-                for save_time in timestamp_to_save:
-                    # update prefix penalties and save state
-                    lines = ""
-                    for prefix_, _ in penalties.items():
-                        # calculate the difference from the last time the
-                        # prefix was updated to the current save_time
-                        assert penalties[prefix_][
-                            "last_penalty_reduction"] != -1, "last penalty reduction cannot be -1"
-                        delta = save_time - penalties[prefix_][
-                            "last_penalty_reduction"]
-
-                        assert delta >= 0, "delta can't be less than 0"
-
-                        # determine the new penalty
-                        # new penalty is N_0 * 0.5^(delta / half_life)
-                        new_penalty = penalties[prefix_]["penalty"] * (0.5**(
-                            delta / (half_life)))
-
-                        # reset penalty if below half the reuse threshold
-                        # this is what Cisco does
-                        if new_penalty < reuse_threshold / 2:
-                            new_penalty = 0
-
-                        # store new penalty
-                        penalties[prefix_]["penalty"] = new_penalty
-                        # store time for which penalty has been calculated
-                        penalties[prefix_][
-                            "last_penalty_reduction"] = save_time
-
-                        # line to save in states file
-                        if new_penalty != 0:
-                            lines += f"{save_time}|{peer['ip']}|{prefix_}|{new_penalty}\n"
-                    saved_states.write(lines.encode())
-                    del lines
+        window_start = window_end
 
-            # update last_ts because saving has been done
-            last_ts = ts
+    return suppressions
 
-            # if first update for prefix then set correct values in dict
-            if prefix not in penalties:
-                last_update_type[prefix] = ""
-
-                # set to the ts of the first update
-                penalties[prefix] = {
-                    "last_penalty_reduction": ts,
-                    "penalty": 0
-                }
-
-            # if penalty has not been reduced by the save mechanism, then reduce it now
-            if ts > penalties[prefix]["last_penalty_reduction"]:
-                # calculate time delta to the last time we updated the penalty
-                delta = ts - penalties[prefix]["last_penalty_reduction"]
-
-                # update the penalty based on the time delta, but only for the
-                # current prefix
-                penalties[prefix]["penalty"] = penalties[prefix]["penalty"] * (
-                    0.5**(delta / (half_life)))
-
-
-                # reset penalty to 0 if below half the reuse-threshold
-                # this is what ciso does according to their docs
-                if penalties[prefix]["penalty"] < reuse_threshold / 2:
-                    penalties[prefix]["penalty"] = 0
-
-                # remember when you last updated the penalty
-                penalties[prefix]["last_penalty_reduction"] = ts
-
-            # increment penalty
-            if upd_type == 'W':
-                penalties[prefix]["penalty"] += withdrawal_penalty
-            elif upd_type == 'A':
-                if last_update_type[prefix] == 'A':
-                    penalties[prefix]["penalty"] += attribute_change_penalty
-                elif last_update_type[prefix] == 'W':
-                    penalties[prefix]["penalty"] += readvertisement_penalty
-                else:
-                    # this happens only for the first update
-                    # TODO does 500/1000 matter in this case?
-                    penalties[prefix]["penalty"] += attribute_change_penalty
 
-            # update last update type
-            last_update_type[prefix] = upd_type
+def open_states_output(filename, size=None):
+    """ opens the states output of a simulation; when resuming, the output
+    is truncated to size (see states_output_size) and appended to """
+    if output_mode == "snapshots" and snapshot_store:
+        store = bap.StateStore(filename, append=size is not None)
+        if size is not None:
+            store.truncate(size)
+        return store
+    if size is None:
+        return gzip.open(filename, "wb+")
+    with open(filename, "r+b") as output:
+        output.truncate(size)
+    return gzip.open(filename, "ab")
 
-        # close states file
-        saved_states.close()
 
-    states_dir = f"states_all_{vendor}_{version}" if not test else "test_states"
-    bap.prep_dir(states_dir)
+def complete_states_output(simulation):
+    """ moves the states output of a finished simulation from its temporary
+    name to its final name, so that partial outputs never look done """
+    filename = simulation["output_filename"]
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    os.replace(simulation["filename"], filename)
+
+
+def states_output_size(simulation):
+    """ size of a closed states output, in rows for a StateStore """
+    if isinstance(simulation["saved_states"], bap.StateStore):
+        return simulation["saved_states"].rows
+    return os.path.getsize(simulation["filename"])
+
+
+def rfd_parameters(vendor,
+                   name=None,
+                   withdrawal_penalty=1000,
+                   readvertisement_penalty=None,
+                   attribute_change_penalty=500,
+                   half_life=15 * 60,
+                   reuse_threshold=750,
+                   suppress_threshold=None,
+                   maximum_suppress_time=60 * 60):
+    """ returns a set of RFD parameters (dict) for simulating the vendor.
+
+    Parameters that are not given default to the vendor's defaults. The name
+    selects the output directory; it defaults to the vendor name for the
+    vendor's default parameters and lists all deviating parameters
+    otherwise. """
+    params = {
+        "vendor": vendor,
+        "withdrawal_penalty": withdrawal_penalty,
+        "readvertisement_penalty": readvertisement_penalty,
+        "attribute_change_penalty": attribute_change_penalty,
+        "half_life": half_life,  # seconds
+        "reuse_threshold": reuse_threshold,
+        "suppress_threshold": suppress_threshold,
+        # None disables the penalty ceiling
+        "maximum_suppress_time": maximum_suppress_time,
+    }
+    if readvertisement_penalty is None:
+        params["readvertisement_penalty"] = 1000 if vendor == "juniper" else 0
+    if suppress_threshold is None:
+        params["suppress_threshold"] = 3000 if vendor == "juniper" else 2000
+
+    if name is None:
+        name = vendor
+        preset = rfd_parameters(vendor, name=vendor)
+        for key, value in params.items():
+            if value != preset[key]:
+                name += f"_{key}-{value}"
+    params["name"] = name
 
-    # ------------------------------------------------------------
-    # RFD parameters
-    # ------------------------------------------------------------
-    withdrawal_penalty = 1000
-    readvertisement_penalty = 1000 if vendor == "juniper" else 0
-    attribute_change_penalty = 500
-    half_life = 15 * 60  # seconds
-    ignore_penalty_threshold = 750 / 2
-
-    # IMPORTANT: MAX SUPPRESS TIME IS NOT IMPLEMENTED
-    maximum_suppress_time = 60 * 60  # 60 minutes
-    reuse_threshold = 750
     # https://tools.ietf.org/html/rfc2439
     # ceiling value formula in Section 4.5
     # max penalty = 12000
-    maximum_penalty = reuse_threshold * (2
-                                         **(maximum_suppress_time / half_life))
+    # capping the penalty bounds the time a prefix stays suppressed after its
+    # last update by maximum_suppress_time
+    params["maximum_penalty"] = None
+    if params["maximum_suppress_time"] is not None:
+        params["maximum_penalty"] = params["reuse_threshold"] * (2**(
+            params["maximum_suppress_time"] / params["half_life"]))
+    return params
+
+
+def get_states_dir(params, version):
+    return f"states_all_{params['name']}_{version}" if not test else "test_states"
+
+
+def new_simulation(params, version):
+    """ returns the initial state of the simulation of one parameter set """
+    return {
+        "params": params,
+        # penalty, last penalty reduction and last update type per prefix
+        "table": bap.PrefixStateTable(version),
+        # penalty changes not yet written in event mode
+        "events": [],
+        # prefix -> currently open suppression
+        "suppressions": dict(),
+        # closed suppressions (start, end, prefix, max_penalty)
+        "suppression_intervals": []
+    }
+
+
+def apply_update(simulation, ts, prefix, upd_type):
+    """ applies an update to the simulation's state and tracks suppressions.
+
+    Returns the penalty increment, the new penalty, the interval of a
+    suppression that ended before the update (or None) and whether the
+    update suppressed the prefix. """
+    table = simulation["table"]
+    params = simulation["params"]
+    half_life = params["half_life"]
+    reuse_threshold = params["reuse_threshold"]
+    reused = None
+    suppressed = False
+
+    # if first update for prefix then the table creates a fresh slot
+    # with penalty 0, last update type "" and the ts of the update
+    slot = table.slot(prefix, ts)
+    penalty = float(table.penalty[slot])
+    last_penalty_reduction = int(table.last_penalty_reduction[slot])
+
+    # if penalty has not been reduced by the save mechanism, then reduce it now
+    if ts > last_penalty_reduction:
+        # calculate time delta to the last time we updated the penalty
+        delta = ts - last_penalty_reduction
+
+        # update the penalty based on the time delta, but only for the
+        # current prefix
+        penalty = penalty * (0.5**(delta / (half_life)))
+
+        # reset penalty to 0 if below half the reuse-threshold
+        # this is what ciso does according to their docs
+        if penalty < reuse_threshold / 2:
+            penalty = 0
+
+        # remember when you last updated the penalty
+        table.last_penalty_reduction[slot] = ts
+
+    # increment penalty
+    last_update_type = table.get_last_update_type(slot)
+    increment = 0
+    if upd_type == 'W':
+        increment = params["withdrawal_penalty"]
+    elif upd_type == 'A':
+        if last_update_type == 'A':
+            increment = params["attribute_change_penalty"]
+        elif last_update_type == 'W':
+            increment = params["readvertisement_penalty"]
+        else:
+            # this happens only for the first update
+            # TODO does 500/1000 matter in this case?
+            increment = params["attribute_change_penalty"]
+    penalty += increment
+
+    # the penalty ceiling implements the maximum suppress time
+    if params["maximum_penalty"] is not None:
+        penalty = min(penalty, params["maximum_penalty"])
+    table.penalty[slot] = penalty
+
+    # a suppressed prefix is reused as soon as its penalty decays
+    # below the reuse threshold
+    suppression = simulation["suppressions"].get(prefix)
+    if suppression is not None and suppression["penalty"] * (0.5**(
+        (ts - suppression["updated"]) / half_life)) < reuse_threshold:
+        reused = close_suppression(suppression, params)
+        simulation["suppression_intervals"].append(reused)
+        del simulation["suppressions"][prefix]
+        suppression = None
+
+    if suppression is not None:
+        suppression["penalty"] = penalty
+        suppression["updated"] = ts
+        suppression["max_penalty"] = max(suppression["max_penalty"],
+                                         penalty)
+    elif penalty > params["suppress_threshold"]:
+        simulation["suppressions"][prefix] = {
+            "start": ts,
+            "prefix": prefix,
+            "penalty": penalty,
+            "updated": ts,
+            "max_penalty": penalty
+        }
+        suppressed = True
+
+    # update last update type
+    table.set_last_update_type(slot, upd_type)
+
+    return increment, penalty, reused, suppressed
+
+
+def snapshot_columns(simulation, save_time):
+    """ decays all penalties to save_time and returns the prefixes and
+    penalties to save """
+    params = simulation["params"]
+    table = simulation["table"]
+
+    # update prefix penalties
+    slots = table.decay(save_time, params["half_life"],
+                        params["reuse_threshold"])
+    return [table.prefixes[slot]
+            for slot in slots.tolist()], table.penalty[slots]
+
+
+def save_snapshot(simulation, save_time, ip):
+    """ decays all penalties to save_time and returns the states file lines """
+    prefixes, penalties = snapshot_columns(simulation, save_time)
+
+    # lines to save in states file
+    return "".join([
+        f"{save_time}|{ip}|{prefix}|{penalty}\n"
+        for prefix, penalty in zip(prefixes, penalties.tolist())
+    ])
+
+
+def write_checkpoint(filename, simulations, param_sets, last_ts,
+                     last_eviction, offset):
+    """ pickles the state of the per-line loop. The output files are closed,
+    which ends their current gzip member, so that their sizes mark the
+    checkpoint; they are reopened in append mode afterwards. """
+    for simulation in simulations:
+        simulation["saved_states"].write("".join(
+            simulation["events"]).encode())
+        simulation["events"] = []
+        simulation["saved_states"].close()
+        simulation["output_size"] = states_output_size(simulation)
+
+    checkpoint = {
+        "param_sets": param_sets,
+        "output_mode": output_mode,
+        "snapshot_store": snapshot_store,
+        "simulations": [{
+            key: value
+            for key, value in simulation.items() if key != "saved_states"
+        } for simulation in simulations],
+        "last_ts": last_ts,
+        "last_eviction": last_eviction,
+        "offset": offset
+    }
+    # replace the last checkpoint only once the new one is complete
+    with open(filename + ".tmp", "wb") as checkpoint_file:
+        pickle.dump(checkpoint, checkpoint_file)
+    os.replace(filename + ".tmp", filename)
+
+    for simulation in simulations:
+        simulation["saved_states"] = open_states_output(
+            simulation["filename"], simulation["output_size"])
+
+
+def load_checkpoint(filename, param_sets):
+    """ returns the checkpoint if it exists and matches the simulation """
+    if not resume or not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as checkpoint_file:
+        checkpoint = pickle.load(checkpoint_file)
+    if checkpoint["param_sets"] != param_sets or checkpoint[
+            "output_mode"] != output_mode or checkpoint[
+                "snapshot_store"] != snapshot_store:
+        bap.log(f"ignoring checkpoint of a different simulation: {filename}")
+        return None
+    return checkpoint
+
+
+def process_vp(peer, version, param_sets):
+    # set first second of the measurement
+    last_ts = (int(config["general"]["start-ts"]) if not test else 0) - 1
+
+    # continue where the last run stopped if there is a checkpoint
+    checkpoint_filename = f"{checkpoint_dir}/{peer['ip']}_{peer['rc']}_{version}.checkpoint"
+    checkpoint = None
+    if engine == "python":
+        checkpoint = load_checkpoint(checkpoint_filename, param_sets)
+
+    # one simulation per parameter set, all of them are fed from a single
+    # read of the VP's dump file
+    simulations = []
+    for params in param_sets:
+        if checkpoint is not None:
+            break
+
+        # open states file
+        states_dir = get_states_dir(params, version)
+        if output_mode == "events":
+            filename = f"{states_dir}/{peer['ip']}_{peer['rc']}_{version}_penalty_events.gz"
+        elif snapshot_store:
+            filename = f"{states_dir}/{peer['ip']}_{peer['rc']}_{version}_saved_states"
+        else:
+            filename = f"{states_dir}/{peer['ip']}_{peer['rc']}_{version}_saved_states.gz"
+
+        #if states file already exists, then skip this parameter set
+        if do_done_check and os.path.exists(filename):
+            continue
+
+        # suppression interval table and its prefix index
+        suppressions_filename = f"{states_dir}/{peer['ip']}_{peer['rc']}_{version}_suppressions.txt"
+        index_filename = f"{states_dir}/{peer['ip']}_{peer['rc']}_{version}_suppressions_index.txt"
+
+        simulation = new_simulation(params, version)
+        simulation["suppressions_filenames"] = (suppressions_filename,
+                                                index_filename)
+        # written under a temporary name until the VP is complete
+        simulation["output_filename"] = filename
+        simulation["filename"] = filename + ".partial"
+        simulation["saved_states"] = open_states_output(simulation["filename"])
+        simulations.append(simulation)
+
+    # uncompressed position in the dump file
+    offset = 0
+    if checkpoint is not None:
+        bap.log(f"resuming from checkpoint: {checkpoint_filename}")
+        simulations = checkpoint["simulations"]
+        last_ts = checkpoint["last_ts"]
+        offset = checkpoint["offset"]
+        # drop everything written after the checkpoint
+        for simulation in simulations:
+            simulation["saved_states"] = open_states_output(
+                simulation["filename"], simulation["output_size"])
+
+    # quit if all parameter sets are done
+    if not simulations:
+        return
+
+    # get filename depending on IP version
+    filename = get_dump_filename(peer, version)
+
+    # stop processing if file does not exist
+    if not os.path.exists(filename):
+        bap.log(f"file does not exist: {filename}")
+        for simulation in simulations:
+            simulation["saved_states"].close()
+            complete_states_output(simulation)
+        return
+
+    if engine == "numpy":
+        columns = load_vp_columns(filename)
+        if (np.diff(columns[0]) < 0).any():
+            bap.log(f"file is not sorted:{filename=}")
+        for simulation in simulations:
+            suppressions = process_vp_numpy(columns,
+                                            simulation["saved_states"], peer,
+                                            last_ts + 1, simulation["params"])
+            simulation["saved_states"].close()
+            write_suppressions(*simulation["suppressions_filenames"], peer,
+                               suppressions)
+            complete_states_output(simulation)
+        return
+
+    last_eviction = last_ts // eviction_interval
+    if checkpoint is not None:
+        last_eviction = checkpoint["last_eviction"]
+    last_checkpoint = time.monotonic()
+
+    for offset, upd_type, prefix, ts, line in read_dump_updates(
+            filename, offset):
+        # parse the timestamp as int because we process updates at second
+        # granularity
+        ts = int(ts)
+
+        # if the lines are not sorted then there is an issue -> print
+        if ts < last_ts:
+            bap.log(
+                f"file is not sorted:{filename=}\n{line}{ts=}{last_ts=}"
+            )
+
+        # find all save-timestamps between the new timestamp and the last timestamp
+        # (not including the last timestamp, but including the new timestamp)
+        # because of the mechanism, the first timestamp is not saved
+        timestamp_to_save = []
+        # if we have reached a new second then ...
+        if output_mode == "snapshots" and ts > last_ts:
+            timestamp_to_save = [
+                save_time for save_time in range(last_ts + 1, ts + 1)
+                if save_time % save_interval == 0
+            ]
+
+        # update last_ts because saving is done below
+        last_ts = ts
+
+        # in event mode nothing decays all prefixes at save times, so fully
+        # decayed prefixes are evicted every eviction_interval seconds
+        timestamp_to_evict = []
+        if output_mode == "events" and ts // eviction_interval > last_eviction:
+            last_eviction = ts // eviction_interval
+            timestamp_to_evict = [ts]
+
+        for simulation in simulations:
+            # save all states thare are to save if there are any
+            for save_time in timestamp_to_save:
+                if isinstance(simulation["saved_states"], bap.StateStore):
+                    prefixes, penalties = snapshot_columns(
+                        simulation, save_time)
+                    simulation["saved_states"].write_arrays(
+                        np.full(len(penalties), save_time), prefixes,
+                        penalties)
+                else:
+                    lines = save_snapshot(simulation, save_time, peer['ip'])
+                    simulation["saved_states"].write(lines.encode())
+                    del lines
+
+            for evict_time in timestamp_to_evict:
+                simulation["table"].decay(
+                    evict_time, simulation["params"]["half_life"],
+                    simulation["params"]["reuse_threshold"])
+
+            increment, penalty, _, _ = apply_update(simulation, ts, prefix,
+                                                    upd_type)
+
+            # in event mode only penalty changes caused by updates are saved
+            if output_mode == "events" and increment != 0:
+                simulation["events"].append(
+                    f"{ts}|{peer['ip']}|{prefix}|{penalty}\n")
+                if len(simulation["events"]) >= 100000:
+                    simulation["saved_states"].write("".join(
+                        simulation["events"]).encode())
+                    simulation["events"] = []
+
+        # checkpoint after fully processing a line
+        if time.monotonic() - last_checkpoint > checkpoint_interval:
+            bap.prep_dir(checkpoint_dir)
+            write_checkpoint(checkpoint_filename, simulations, param_sets,
+                             last_ts, last_eviction, offset)
+            last_checkpoint = time.monotonic()
+
+    # close states files
+    for simulation in simulations:
+        simulation["saved_states"].write("".join(
+            simulation["events"]).encode())
+        simulation["saved_states"].close()
+
+        # prefixes that are still suppressed are reused once their penalty
+        # has decayed, even if that is after the end of the file
+        intervals = simulation["suppression_intervals"] + [
+            close_suppression(suppression, simulation["params"])
+            for suppression in simulation["suppressions"].values()
+        ]
+        write_suppressions(
+            *simulation["suppressions_filenames"], peer,
+            pd.DataFrame(intervals,
+                         columns=["start", "end", "prefix", "max_penalty"]))
+
+    # the outputs are complete, a later run must not resume
+    if os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+    for simulation in simulations:
+        complete_states_output(simulation)
+
+
+def open_stream(source):
+    """ returns a binary line stream for source, which is either "-" (stdin),
+    "unix:<path>" or "tcp:<host>:<port>" (connects to a local socket), or a
+    path, e.g. of a named pipe """
+    if source == "-":
+        return sys.stdin.buffer
+    if source.startswith("unix:"):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(source[len("unix:"):])
+        return connection.makefile("rb")
+    if source.startswith("tcp:"):
+        host, port = source[len("tcp:"):].rsplit(':', 1)
+        return socket.create_connection((host, int(port))).makefile("rb")
+    return open(source, "rb")
+
+
+def stream(source, output, param_sets):
+    """ simulates RFD on an unbounded stream of updates in the format of the
+    *_dumps_no_dupes.gz files, for all VPs found in the stream.
+
+    Writes one line kind|parameter set|ts|peer-ip|prefix|value per record:
+    P for penalty snapshots (every save_interval seconds of stream time), E
+    for penalty changes (event mode), S when a prefix is suppressed and R
+    when it is reused (value is the maximum penalty). Reuses are detected at
+    least once per save_interval and output is flushed at every save time
+    or after stream_flush_interval seconds without input. Memory is bounded
+    by the prefix tables, which evict fully decayed prefixes. """
+    # read in a separate thread so that idle streams still get flushed
+    lines = queue.Queue(maxsize=stream_queue_size)
+
+    def read():
+        for line in open_stream(source):
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+
+    def emit(kind, params, ts, ip, prefix, value):
+        output.write(f"{kind}|{params['name']}|{ts}|{ip}|{prefix}|{value}\n")
+
+    # (peer-ip, rc-name, version) -> simulations
+    vps = dict()
+    last_ts = None
+
+    while True:
+        try:
+            line = lines.get(timeout=stream_flush_interval)
+        except queue.Empty:
+            output.flush()
+            continue
+        if line is None:
+            break
+
+        # parse update line
+        try:
+            message_type, upd_type, rc_project, rc_name, peer_AS, peer_ip,\
+                    next_hop, path, origin_AS, communities, atomic_agg,\
+                    agg_ip, agg_AS, med, isv6, prefix, ts \
+                    = line.decode().split('|')
+            ts = int(float(ts.rstrip()))
+        except ValueError:
+            bap.log(f"parsing error\n{line.decode()}")
+            continue
+
+        if last_ts is None:
+            last_ts = ts - 1
+
+        # the stream time advances with the newest update of any VP
+        if ts > last_ts:
+            timestamp_to_save = [
+                save_time for save_time in range(last_ts + 1, ts + 1)
+                if save_time % save_interval == 0
+            ]
+            last_ts = ts
+
+            # all prefixes are decayed (and fully decayed ones evicted) at
+            # every save time, also in event mode
+            for (ip, _, _), simulations in vps.items():
+                for simulation in simulations:
+                    params = simulation["params"]
+                    for save_time in timestamp_to_save:
+                        snapshot = save_snapshot(simulation, save_time, ip)
+                        if output_mode == "snapshots":
+                            for row in snapshot.splitlines():
+                                output.write(f"P|{params['name']}|{row}\n")
+
+                        # reuse suppressed prefixes whose penalty decayed
+                        for suppression in list(
+                                simulation["suppressions"].values()):
+                            reused = close_suppression(suppression, params)
+                            if reused[1] <= save_time:
+                                del simulation["suppressions"][reused[2]]
+                                emit('R', params, reused[1], ip, reused[2],
+                                     reused[3])
+            if timestamp_to_save:
+                output.flush()
+
+        version = "v6" if ':' in prefix else "v4"
+        key = (peer_ip, rc_name, version)
+        if key not in vps:
+            vps[key] = [
+                new_simulation(params, version) for params in param_sets
+            ]
+
+        for simulation in vps[key]:
+            params = simulation["params"]
+            increment, penalty, reused, suppressed = apply_update(
+                simulation, ts, prefix, upd_type)
+            # closed suppressions are emitted right away
+            simulation["suppression_intervals"] = []
+
+            if reused is not None:
+                emit('R', params, reused[1], peer_ip, prefix, reused[3])
+            if output_mode == "events" and increment != 0:
+                emit('E', params, ts, peer_ip, prefix, penalty)
+            if suppressed:
+                emit('S', params, ts, peer_ip, prefix, penalty)
+
+    output.flush()
+
+
+def main(version, param_sets):
+    for params in param_sets:
+        bap.prep_dir(get_states_dir(params, version))
 
     # ------------------------------------------------------------
     # INIT
@@ -206,19 +1024,49 @@ def main(vendor, version):
         peers = list(
             map(
                 lambda line: dict(
-                    zip(["project", "rc", "asn", "ip"], line.split('|'))),
+                    zip(["project", "rc", "asn", "ip", "updates", "bytes"],
+                        line.split('|'))),
                 open(f"./rc_mapping_{version}").read().splitlines()))
-        bap.paral(process_vp, [peers])
+        sizes = [int(peer.get("bytes", 0)) for peer in peers]
+        bap.paral(process_vp,
+                  [peers, [version] * len(peers), [param_sets] * len(peers)],
+                  costs=sizes,
+                  memory=[size * memory_per_byte for size in sizes],
+                  memory_budget=memory_budget)
     else:
-        process_vp({"rc": "test-rc", "ip": "test-ip"})
+        process_vp({"rc": "test-rc", "ip": "test-ip"}, version, param_sets)
+
+
+# ------------------------------------------------------------
+# RFD parameters
+# ------------------------------------------------------------
+# all parameter sets are simulated in a single pass over each VP's updates,
+# e.g. add rfd_parameters("cisco", half_life=10 * 60) to sweep the half-life
+param_sets = [rfd_parameters("cisco"), rfd_parameters("juniper")]
+if test:
+    # the manual check file was computed without the penalty ceiling
+    param_sets = [rfd_parameters("cisco", maximum_suppress_time=None)]
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--stream",
+                    metavar="SOURCE",
+                    help="simulate live on updates read from SOURCE: - "
+                    "(stdin), unix:<path>, tcp:<host>:<port> or a named pipe")
+parser.add_argument("--output",
+                    default="-",
+                    help="output file of the stream mode, - for stdout")
+args = parser.parse_args()
 
-for vendor, version in itertools.product(["cisco", "juniper"], ["v4", "v6"]):
-    bap.log(f"{version=}, {vendor=}")
-    main(vendor, version)
+if args.stream is not None:
+    output = sys.stdout if args.output == "-" else open(args.output, "a")
+    stream(args.stream, output, param_sets)
+else:
+    for version in ["v4", "v6"]:
+        bap.log(f"{version=}, {[params['name'] for params in param_sets]}")
+        main(version, param_sets)
 
-    if test:
-        break
+        if test:
+            break
 
 if test:
     # check if output file is correct